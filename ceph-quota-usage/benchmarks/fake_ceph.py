@@ -0,0 +1,246 @@
+import sys
+import json
+import time
+import types
+import zlib
+import itertools
+import posixpath
+
+#
+# An in-process stand-in for the parts of the rados and cephfs bindings that cephfs_quota_usage.py
+# uses, serving a synthetic directory tree. The tree is never held in memory: every directory's
+# children and xattrs are derived from its path, so trees of millions of directories cost nothing
+# to build. Each call can be given a latency (slept, so that like the real calls it releases the GIL).
+#
+
+# Name to (id, size, erasure code profile) of each pool
+POOLS = {"cephfs_data": (1, 3, None), "cephfs_ec": (2, 6, "ec42")}
+ERASURE_CODE_PROFILES = {"ec42": {"k": "4", "m": "2", "plugin": "jerasure"}}
+NO_DATA_AVAIL_ERROR_NUM = 61
+NOT_FOUND_ERROR_NUM = 2
+DIR_TYPE = 4
+FILE_TYPE = 8
+
+
+class Error(Exception):
+    pass
+
+
+class OSError(Error):
+    def __init__(self, errno, strerror=""):
+        super().__init__(errno, strerror)
+        self.errno = errno
+
+
+class NoData(OSError):
+    pass
+
+
+class ObjectNotFound(OSError):
+    pass
+
+
+class SyntheticTree:
+    # A tree with fanouts[i] sub-directories under each directory i levels below root. Every
+    # quota_every'th directory has a quota (the others have quotas of 0), and every directory
+    # holds one file besides its sub-directories.
+    def __init__(self, root, fanouts, quota_every=3):
+        self.root = posixpath.normpath(root)
+        self.fanouts = tuple(fanouts)
+        self.quota_every = quota_every
+
+    def get_level(self, path):
+        # How many levels below root path is, or None if path isn't in the tree
+        path = posixpath.normpath(path)
+        if path == self.root:
+            return 0
+        relative_path = posixpath.relpath(path, self.root)
+        if relative_path.startswith(".."):
+            return None
+        names = relative_path.split("/")
+        if len(names) > len(self.fanouts):
+            return None
+        for level, name in enumerate(names):
+            if not (name.startswith("d") and name[1:].isdigit() and int(name[1:]) < self.fanouts[level]):
+                return None
+        return len(names)
+
+    def get_subdir_count(self, level):
+        return self.fanouts[level] if level < len(self.fanouts) else 0
+
+    def get_xattrs(self, path, level):
+        seed = zlib.crc32(path.encode())
+        xattrs = {
+            "ceph.dir.rbytes": str(seed * 4099),
+            "ceph.dir.rfiles": str(seed % 1000003),
+            "ceph.dir.rctime": f"{1600000000 + seed % 100000000}.000000000",
+            "ceph.dir.layout.json": json.dumps({"pool_name": list(POOLS)[seed % len(POOLS)]}),
+            "ceph.dir.subdirs": str(self.get_subdir_count(level)),
+        }
+        has_quota = seed % self.quota_every == 0
+        xattrs["ceph.quota.max_bytes"] = str(seed * 8191 if has_quota else 0)
+        xattrs["ceph.quota.max_files"] = str(seed % 2000003 if has_quota else 0)
+        return xattrs
+
+
+class Latency:
+    # Per-call latencies in seconds, e.g. Latency(getxattr=0.0005, readdir=0.0001)
+    def __init__(self, **call_latencies):
+        self.call_latencies = call_latencies
+
+    def wait(self, call):
+        latency = self.call_latencies.get(call)
+        if latency:
+            time.sleep(latency)
+
+
+class DirEntry:
+    def __init__(self, d_name, d_type):
+        self.d_name = d_name
+        self.d_type = d_type
+
+
+class DirHandle:
+    def __init__(self, names):
+        self.names = names
+
+
+class Rados:
+    tree = None
+    latency = Latency()
+
+    def __init__(self, *args, **kwargs):
+        self.connected = False
+
+    def connect(self):
+        self.latency.wait("connect")
+        self.connected = True
+
+    def shutdown(self):
+        self.connected = False
+
+    def mon_command(self, cmd, inbuf):
+        self.latency.wait("mon_command")
+        command = json.loads(cmd)
+        if command["prefix"] == "df":
+            tebibyte = 2 ** 40
+            df = {
+                "stats_by_class": {
+                    "hdd": {
+                        "total_bytes": 500 * tebibyte,
+                        "total_avail_bytes": 300 * tebibyte,
+                        "total_used_bytes": 200 * tebibyte,
+                        "total_used_raw_bytes": 200 * tebibyte,
+                        "total_used_raw_ratio": 0.4,
+                    }
+                },
+                "pools": [
+                    {
+                        "name": name,
+                        "id": pool_id,
+                        "stats": {"stored": 50 * tebibyte, "max_avail": 100 * tebibyte, "percent_used": 0.25},
+                    }
+                    for name, (pool_id, size, profile) in POOLS.items()
+                ],
+            }
+            return 0, json.dumps(df).encode(), ""
+        if command["prefix"] == "osd dump":
+            osd_dump = {
+                "pools": [
+                    {
+                        "pool": pool_id,
+                        "pool_name": name,
+                        "type": 3 if profile else 1,
+                        "size": size,
+                        "crush_rule": 1 if profile else 0,
+                        "erasure_code_profile": profile or "",
+                    }
+                    for name, (pool_id, size, profile) in POOLS.items()
+                ],
+                "erasure_code_profiles": ERASURE_CODE_PROFILES,
+            }
+            return 0, json.dumps(osd_dump).encode(), ""
+        if command["prefix"] == "osd crush rule dump":
+            rules = [
+                {"rule_id": 0, "rule_name": "replicated_ssd", "steps": [{"op": "take", "item_name": "default~ssd"}]},
+                {"rule_id": 1, "rule_name": "ec42_hdd", "steps": [{"op": "take", "item_name": "default~hdd"}]},
+            ]
+            return 0, json.dumps(rules).encode(), ""
+        return -22, b"", f"command not supported by the fake cluster: {command['prefix']}"
+
+
+class LibCephFS:
+    def __init__(self, rados_inst=None):
+        self.cluster = rados_inst
+        self.tree = Rados.tree
+        self.latency = Rados.latency
+        self.mount_root = "/"
+
+    def mount(self, mount_root=None, filesystem_name=None):
+        self.latency.wait("mount")
+        self.mount_root = mount_root.decode() if mount_root else "/"
+
+    def unmount(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+    def get_path(self, path):
+        return posixpath.normpath(posixpath.join(self.mount_root, path.decode()))
+
+    def getxattr(self, path, name):
+        self.latency.wait("getxattr")
+        path = self.get_path(path)
+        level = self.tree.get_level(path)
+        if level is None:
+            raise ObjectNotFound(NOT_FOUND_ERROR_NUM, f"no such directory: {path}")
+        value = self.tree.get_xattrs(path, level).get(name)
+        if value is None:
+            raise NoData(NO_DATA_AVAIL_ERROR_NUM, f"no data available: {name}")
+        return value.encode()
+
+    def opendir(self, path):
+        self.latency.wait("opendir")
+        path = self.get_path(path)
+        level = self.tree.get_level(path)
+        if level is None:
+            raise ObjectNotFound(NOT_FOUND_ERROR_NUM, f"no such directory: {path}")
+        subdir_count = self.tree.get_subdir_count(level)
+        width = len(str(subdir_count))
+        entries = [DirEntry(b".", DIR_TYPE), DirEntry(b"..", DIR_TYPE)]
+        entries_iter = (DirEntry(f"d{i:0{width}d}".encode(), DIR_TYPE) for i in range(subdir_count))
+        return DirHandle(itertools.chain(entries, entries_iter, [DirEntry(b"README", FILE_TYPE)]))
+
+    def readdir(self, handle):
+        self.latency.wait("readdir")
+        return next(handle.names, None)
+
+    def closedir(self, handle):
+        pass
+
+    def get_pool_id(self, pool_name):
+        return POOLS[pool_name][0]
+
+    def get_pool_replication(self, pool_id):
+        for name, (id_, size, profile) in POOLS.items():
+            if id_ == pool_id:
+                return size
+        raise ObjectNotFound(NOT_FOUND_ERROR_NUM, f"no such pool: {pool_id}")
+
+
+def install(tree, latency=None):
+    # Registers fake rados and cephfs modules, which must happen before cephfs_quota_usage is imported
+    Rados.tree = tree
+    Rados.latency = latency or Latency()
+
+    rados_module = types.ModuleType("rados")
+    rados_module.Rados = Rados
+    rados_module.Error = Error
+
+    cephfs_module = types.ModuleType("cephfs")
+    for cls in (LibCephFS, Error, OSError, NoData, ObjectNotFound):
+        setattr(cephfs_module, cls.__name__, cls)
+
+    sys.modules["rados"] = rados_module
+    sys.modules["cephfs"] = cephfs_module
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import itertools
+import tempfile
+import statistics
+
+import fake_ceph
+
+#
+# Benchmarks the scan, report building and formatting stages of cephfs_quota_usage.py against
+# fake_ceph's synthetic trees, e.g.
+#   python3 run_benchmarks.py --sizes 1000 100000 --latency getxattr=0.0002 -w 16
+#
+
+BENCH_CLUSTER = "BENCH"
+BENCH_ROOT = "/bench"
+
+
+def parse_size(size):
+    multipliers = {"k": 1000, "m": 1000000}
+    if size[-1].lower() in multipliers:
+        return int(size[:-1]) * multipliers[size[-1].lower()]
+    return int(size)
+
+
+def parse_latency(latency):
+    call, seconds = latency.split("=")
+    return call, float(seconds)
+
+
+def get_fanouts(size, depth):
+    # Spreads size directories evenly over depth levels (so there are at least size directories)
+    fanout = math.ceil(size ** (1 / depth))
+    while fanout > 1 and (fanout - 1) ** depth >= size:
+        fanout -= 1
+    return (fanout,) * depth
+
+
+def run_stage(results, name, repeat, stage):
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = stage()
+        times.append(time.perf_counter() - start)
+    results[name] = {"min_seconds": min(times), "median_seconds": statistics.median(times)}
+    return value
+
+
+def benchmark_size(quota_usage, size, args):
+    fanouts = get_fanouts(size, args.depth)
+    fake_ceph.Rados.tree = fake_ceph.SyntheticTree(BENCH_ROOT, fanouts)
+    quota_usage.parse_args(
+        [
+            "-c",
+            f"{BENCH_CLUSTER}:bench:benchfs:/",
+            "-d",
+            f"{BENCH_CLUSTER}:{BENCH_ROOT}/",
+            "-w",
+            str(args.workers),
+            "--depth",
+            str(args.depth),
+            "--snapshot-file",
+            "",
+            "--run-metrics-pattern",
+            "",
+        ]
+        + args.quota_usage_args
+    )
+    level_sizes = itertools.accumulate(fanouts, lambda level_size, fanout: level_size * fanout)
+    results = {"directories": sum(level_sizes), "fanouts": fanouts}
+
+    with quota_usage.connect_to_cluster(BENCH_CLUSTER) as ceph_cluster, tempfile.TemporaryDirectory() as report_dir:
+        cluster_fs = ceph_cluster.mount("/")
+
+        def scan():
+            cluster_fs.clear_cache()
+            return list(quota_usage.get_quota_rows(cluster_fs, BENCH_CLUSTER, "/"))
+
+        def build_report():
+            collector = quota_usage.QuotaTableCollector(quota_usage.QuotaRow.FIELDS, args.html_top_n)
+            quota_filename = os.path.join(report_dir, "quota.csv")
+            quota_usage.write_to_file(
+                quota_filename, quota_usage.QuotaRow.header(), collector.collect(rows), quota_usage.QuotaRow.FIELDS
+            )
+            storage_rows, pools_rows = quota_usage.get_storage_and_pool_data(ceph_cluster, collector.backing_pools)
+            return [
+                quota_usage.ReportTable(
+                    "storage.csv", tuple(storage_rows[0].keys()), [tuple(row.values()) for row in storage_rows]
+                ),
+                quota_usage.ReportTable(
+                    quota_filename,
+                    quota_usage.QuotaRow.header(),
+                    collector.get_table_rows(),
+                    collector.get_description(),
+                ),
+            ]
+
+        def format_html():
+            return quota_usage.BaseFormatter(tables=tables).get_html()
+
+        rows = run_stage(results, "scan", args.repeat, scan)
+        results["rows"] = len(rows)
+        tables = run_stage(results, "build_report", args.repeat, build_report)
+        html = run_stage(results, "format_html", args.repeat, format_html)
+        results["html_bytes"] = len(html)
+
+    return results
+
+
+def main(args):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", nargs="*", default=["1k", "100k", "1M"])
+    parser.add_argument("--depth", type=int, default=1)
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("--latency", nargs="*", type=parse_latency, default=[])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--html-top-n", type=int, default=None)
+    parser.add_argument("--json", dest="json_file", default=None)
+    # Any other arguments are passed on to cephfs_quota_usage.py (e.g. --sort-chunk-size)
+    parsed_args, parsed_args.quota_usage_args = parser.parse_known_args(args)
+
+    fake_ceph.install(fake_ceph.SyntheticTree(BENCH_ROOT, ()), fake_ceph.Latency(**dict(parsed_args.latency)))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+    import cephfs_quota_usage
+
+    all_results = dict()
+    for size in parsed_args.sizes:
+        results = benchmark_size(cephfs_quota_usage, parse_size(size), parsed_args)
+        all_results[size] = results
+        stages = ", ".join(
+            f"{stage} {results[stage]['min_seconds']:.3f}s" for stage in ("scan", "build_report", "format_html")
+        )
+        print(f"{size:>6} ({results['directories']} directories, {results['rows']} rows): {stages}")
+
+    if parsed_args.json_file:
+        with open(parsed_args.json_file, "w") as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
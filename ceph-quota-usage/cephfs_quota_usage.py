@@ -1,20 +1,40 @@
 #!/usr/bin/env python3
 
+import io
 import os
-import csv
+import re
 import sys
 import json
 import math
-import rados
-import cephfs
-import smtplib
+import gzip
+import heapq
+import operator
+import zlib
+import pickle
+import time
+import queue
+import shutil
 import argparse
 import datetime
-from pathlib import Path
-from email import encoders
-from email.mime.base import MIMEBase
+import tempfile
+import threading
+import itertools
+import concurrent.futures
+from functools import partial
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor
+from email import policy
 from email.message import EmailMessage
-from email_formatter import BaseFormatter
+from email.generator import BytesGenerator
+from email_formatter import BaseFormatter, ReportTable, load_report_table
+from group_fanout import get_group_tables, load_group_recipients
+from quota_journal import QuotaScanJournal
+from concurrency_limit import AdaptiveConcurrencyLimit
+from quota_row import QuotaRow
+from report_writers import CSVReportWriter, EXPORT_WRITERS
+from quota_delta import DELTA_HEADER, QuotaDeltaCollector, load_report_rows
+from smtp_delivery import MailDelivery
+from run_metrics import metrics
 
 DEFAULT_REPORT_DIRS = [
     "HTC:/staging/",
@@ -34,6 +54,10 @@ DEFAULT_CLUSTERS = ["HTC:INF-896:htc-cephfs:/staging,/projects", "HPC:quotarepor
 
 
 class Options:
+    args = None
+    render = False
+    report_date = None
+    html_only = False
     report_dirs = None
     report_file_pattern = None
     storage_file_pattern = "Storage_By_Class"
@@ -45,19 +69,139 @@ class Options:
     cluster_mount_paths = None
     sort_by = "bytes_used"
     sort_reverse = True
+    scan_workers = 1
+    parallel = False
+    snapshot_file = "Quota_Usage_Snapshot.sqlite3"
+    full_scan = False
+    journal_pattern = "Quota_Scan_Journal"
+    resume = False
+    call_timeout = None
+    scan_budget = None
+    scan_deadlines = False
+    latency_target = None
+    concurrency_caps = dict()
+    sort_chunk_size = 100000
+    depth = 1
+    history_dir = None
+    history_window = 30
+    html_top_n = None
+    html_top_by = "bytes_used"
+    compress_attachments = False
+    max_message_size = None
+    smtp_host = "postfix-mail"
+    smtp_port = 587
+    smtp_retries = 3
+    mail_queue_dir = "Quota_Report_Mail_Queue"
+    delta = False
+    delta_file_pattern = "Quota_Usage_Changes"
+    delta_min_bytes = 10.0
+    delta_min_files = 10000
+    delta_thresholds = (80, 90, 100)
+    export_formats = ()
+    group_recipients = None
+    shard = None
+    shards = None
+    merge_shards = None
+    shard_dir = "Quota_Report_Shards"
+    engine = "threads"
+    run_metrics_pattern = "Quota_Run_Metrics"
+    email_run_metrics = False
+    serve_port = None
+    serve_address = ""
+    refresh_interval = 900
 
 
 options = Options()
 
 
+def parse_shard(shard):
+    # "<index>/<count>", e.g. "0/4" for the first of four shards
+    try:
+        index, count = (int(value) for value in shard.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {shard}, expected <index>/<count>")
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {shard}, the index must be from 0 to count - 1")
+    return index, count
+
+
+def parse_concurrency_cap(cap):
+    # "<cluster>:<max calls in flight>", e.g. "HTC:16"
+    try:
+        cluster, max_concurrency = cap.rsplit(":", 1)
+        return cluster, max(1, int(max_concurrency))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid concurrency cap {cap}, expected <cluster>:<count>")
+
+
+def parse_date(date):
+    try:
+        return datetime.datetime.strptime(date, "%Y-%m-%d").date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {date}, expected YYYY-MM-DD")
+
+
 def parse_args(args):
+    # "render" as the first argument renders the emails of reports that were already written, without Ceph
+    options.render = bool(args) and args[0] == "render"
+    option_args = args[1:] if options.render else args
     parser = argparse.ArgumentParser()
     parser.add_argument("-d", "--directories", nargs="*", default=DEFAULT_REPORT_DIRS)
     parser.add_argument("-o", "--output_file_pattern", default=DEFAULT_REPORT_PATTERN)
     parser.add_argument("-s", "--sender", default=DEFAULT_SENDER_ADDRESS)
     parser.add_argument("-r", "--receivers", nargs="*", default=DEFAULT_RECEIVER_ADDRESSES)
     parser.add_argument("-c", "--clusters", nargs="*", default=DEFAULT_CLUSTERS)
-    parsed_args = parser.parse_args(args)
+    parser.add_argument("-w", "--workers", type=int, default=1)
+    parser.add_argument("-p", "--parallel", action="store_true")
+    parser.add_argument("--snapshot-file", default=Options.snapshot_file)
+    parser.add_argument("--full", action="store_true")
+    parser.add_argument("--journal-pattern", default=Options.journal_pattern)
+    parser.add_argument("--resume", action="store_true")
+    parser.add_argument("--call-timeout", type=float, default=Options.call_timeout)
+    parser.add_argument("--scan-budget", type=float, default=Options.scan_budget)
+    parser.add_argument("--latency-target", type=float, default=Options.latency_target)
+    parser.add_argument("--concurrency-caps", nargs="*", type=parse_concurrency_cap, default=[])
+    parser.add_argument("--sort-chunk-size", type=int, default=Options.sort_chunk_size)
+    parser.add_argument("--depth", type=int, default=Options.depth)
+    parser.add_argument("--history-dir", default=Options.history_dir)
+    parser.add_argument("--history-window", type=int, default=Options.history_window)
+    parser.add_argument("--html-top-n", type=int, default=Options.html_top_n)
+    parser.add_argument(
+        "--html-top-by",
+        choices=("bytes_used", "bytes_percent", "files_used", "files_percent"),
+        default=Options.html_top_by,
+    )
+    parser.add_argument("--compress-attachments", action="store_true")
+    parser.add_argument("--max-message-size", type=int, default=Options.max_message_size)
+    parser.add_argument("--smtp-host", default=Options.smtp_host)
+    parser.add_argument("--smtp-port", type=int, default=Options.smtp_port)
+    parser.add_argument("--smtp-retries", type=int, default=Options.smtp_retries)
+    parser.add_argument("--mail-queue-dir", default=Options.mail_queue_dir)
+    parser.add_argument("--export-formats", nargs="*", choices=tuple(EXPORT_WRITERS), default=Options.export_formats)
+    parser.add_argument("--group-recipients")
+    parser.add_argument("--shard", type=parse_shard, default=Options.shard)
+    parser.add_argument("--shards", type=int, default=Options.shards)
+    parser.add_argument("--merge-shards", type=int, default=Options.merge_shards)
+    parser.add_argument("--shard-dir", default=Options.shard_dir)
+    parser.add_argument("--delta", action="store_true")
+    parser.add_argument("--delta-file-pattern", default=Options.delta_file_pattern)
+    parser.add_argument("--delta-min-bytes", type=float, default=Options.delta_min_bytes)
+    parser.add_argument("--delta-min-files", type=int, default=Options.delta_min_files)
+    parser.add_argument("--delta-thresholds", nargs="*", type=float, default=Options.delta_thresholds)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default=Options.engine)
+    parser.add_argument("--run-metrics-pattern", default=Options.run_metrics_pattern)
+    parser.add_argument("--email-run-metrics", action="store_true")
+    parser.add_argument("--serve", type=int, dest="serve_port", default=Options.serve_port)
+    parser.add_argument("--serve-address", default=Options.serve_address)
+    parser.add_argument("--refresh-interval", type=int, default=Options.refresh_interval)
+    if options.render:
+        parser.add_argument("--date", type=parse_date, default=Options.report_date)
+        parser.add_argument("--html-only", action="store_true")
+    parsed_args = parser.parse_args(option_args)
+    for name in ("call_timeout", "scan_budget"):
+        value = getattr(parsed_args, name)
+        if not value is None and value <= 0:
+            parser.error(f"--{name.replace('_', '-')} must be a positive number of seconds")
     try:
         # Form a Cluster-Identifier to List-of-Directory-Paths dictionary
         report_dirs_dict = dict()
@@ -75,10 +219,59 @@ def parse_args(args):
     except Exception as e:
         print(f"Error creating Cluster-Directory mapping: {e}")
         raise e
+    # Keep the raw arguments so that worker processes can parse the same options
+    options.args = args
     options.report_dirs = report_dirs_dict
     options.report_file_pattern = parsed_args.output_file_pattern
     options.sender = parsed_args.sender
     options.receivers = parsed_args.receivers
+    options.scan_workers = max(1, parsed_args.workers)
+    options.parallel = parsed_args.parallel
+    options.snapshot_file = parsed_args.snapshot_file
+    options.full_scan = parsed_args.full
+    options.journal_pattern = parsed_args.journal_pattern
+    options.resume = parsed_args.resume
+    options.call_timeout = parsed_args.call_timeout
+    options.scan_budget = parsed_args.scan_budget
+    # Only a scan with a time limit can leave directories with their last known rows
+    options.scan_deadlines = not options.call_timeout is None or not options.scan_budget is None
+    options.latency_target = parsed_args.latency_target
+    options.concurrency_caps = dict(parsed_args.concurrency_caps)
+    options.sort_chunk_size = max(1, parsed_args.sort_chunk_size)
+    options.depth = max(1, parsed_args.depth)
+    options.history_dir = parsed_args.history_dir
+    options.history_window = parsed_args.history_window
+    options.html_top_n = parsed_args.html_top_n
+    options.html_top_by = parsed_args.html_top_by
+    options.compress_attachments = parsed_args.compress_attachments
+    options.max_message_size = parsed_args.max_message_size
+    options.smtp_host = parsed_args.smtp_host
+    options.smtp_port = parsed_args.smtp_port
+    options.smtp_retries = max(0, parsed_args.smtp_retries)
+    options.mail_queue_dir = parsed_args.mail_queue_dir
+    options.export_formats = parsed_args.export_formats
+    options.group_recipients = None
+    if parsed_args.group_recipients:
+        options.group_recipients = load_group_recipients(parsed_args.group_recipients)
+    options.shard = parsed_args.shard
+    options.shards = parsed_args.shards
+    # Running the shards locally merges them too
+    options.merge_shards = parsed_args.merge_shards or parsed_args.shards
+    options.shard_dir = parsed_args.shard_dir
+    options.delta = parsed_args.delta
+    options.delta_file_pattern = parsed_args.delta_file_pattern
+    options.delta_min_bytes = parsed_args.delta_min_bytes
+    options.delta_min_files = parsed_args.delta_min_files
+    options.delta_thresholds = parsed_args.delta_thresholds
+    options.engine = parsed_args.engine
+    options.run_metrics_pattern = parsed_args.run_metrics_pattern
+    options.email_run_metrics = parsed_args.email_run_metrics
+    options.serve_port = parsed_args.serve_port
+    options.serve_address = parsed_args.serve_address
+    options.refresh_interval = parsed_args.refresh_interval
+    if options.render:
+        options.report_date = parsed_args.date
+        options.html_only = parsed_args.html_only
     # Create Cluster-Identifier to Client-Name dictionary
     cluster_clients = dict()
     # Create Cluster-Identifier to Filesystem-Name dictionary
@@ -87,6 +280,9 @@ def parse_args(args):
     cluster_mount_paths = dict()
     for cluster in parsed_args.clusters:
         cluster_client_split = str(cluster).split(":")
+        if options.render and len(cluster_client_split) == 1:
+            # Rendering only needs the cluster identifiers
+            cluster_client_split += [None, None, ""]
         cluster_clients[cluster_client_split[0]] = cluster_client_split[1]
         filesystem_names[cluster_client_split[0]] = cluster_client_split[2]
         cluster_mount_paths[cluster_client_split[0]] = cluster_client_split[3].split(",")
@@ -95,15 +291,118 @@ def parse_args(args):
     options.cluster_mount_paths = cluster_mount_paths
 
 
-# TODO: better class name
-class CephFS_Wrapper:
-    DIRENTRY_TYPE = {"DIR": 4, "FILE": 8, "LINK": "A"}
-    NO_DATA_AVAIL_ERROR_NUM = 61
+class ScanDeadline:
+    # The time budget of a cluster's scan, and how long any one directory's reads may take
+    def __init__(self, budget=None, call_timeout=None):
+        self.end_time = time.monotonic() + budget if budget else None
+        self.call_timeout = call_timeout
+
+    def expired(self):
+        return not self.end_time is None and time.monotonic() >= self.end_time
+
+    def get_remaining(self):
+        # What's left of the budget, or None without one
+        return None if self.end_time is None else max(self.end_time - time.monotonic(), 0)
+
+    def get_timeout(self):
+        timeouts = [self.call_timeout, self.get_remaining()]
+        return min((timeout for timeout in timeouts if not timeout is None), default=None)
+
+
+class TimedCallPool:
+    # Runs calls on a pool of daemon threads, waiting for each one for at most a timeout. A call that
+    # takes longer is left to finish in the background and its thread is replaced in the pool, so a
+    # stuck MDS request doesn't hold up the scan (or the script's exit). on_abandon is called with the
+    # future of each call that is left running. At most workers threads are replaced at a time, past
+    # that the pool runs with fewer threads until the stuck calls finish.
+    def __init__(self, workers, on_abandon=None):
+        self.calls = queue.Queue()
+        self.lock = threading.Lock()
+        self.max_replaced_calls = workers
+        self.abandoned_calls = set()
+        self.replaced_calls = set()
+        self.on_abandon = on_abandon
+        self.local = threading.local()
+        for _ in range(workers):
+            threading.Thread(target=self.work, daemon=True).start()
+
+    def work(self):
+        while True:
+            future, func, args = self.calls.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            self.local.call = future
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            self.local.call = None
+            with self.lock:
+                self.abandoned_calls.discard(future)
+                if future in self.replaced_calls:
+                    # This thread was replaced while its call was running
+                    self.replaced_calls.discard(future)
+                    return
+
+    def call(self, timeout, func, *args):
+        future = concurrent.futures.Future()
+        self.calls.put((future, func, args))
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            with self.lock:
+                if future.cancel():
+                    # It was still waiting for a thread
+                    raise
+                finished = future.done()
+                replace = False
+                if not finished:
+                    self.abandoned_calls.add(future)
+                    replace = len(self.replaced_calls) < self.max_replaced_calls
+                    if replace:
+                        self.replaced_calls.add(future)
+            if finished:
+                return future.result()
+            if not self.on_abandon is None:
+                self.on_abandon(future)
+            if replace:
+                threading.Thread(target=self.work, daemon=True).start()
+            raise
+
+    def get_current_call(self):
+        # The future of the call running on this thread, if it's one of the pool's threads
+        return getattr(self.local, "call", None)
+
+    def is_abandoned(self, future):
+        with self.lock:
+            return future in self.abandoned_calls
+
+    def has_abandoned_calls(self):
+        with self.lock:
+            return bool(self.abandoned_calls)
+
+
+class CephCluster:
     POOL_STATS = ["stored", "max_avail", "percent_used"]
+    # Pool "type" values in the OSD map
+    REPLICATED_POOL_TYPE = 1
+    ERASURE_POOL_TYPE = 3
     cluster = None
-    fs = None
+    pool_metadata = None
+
+    def __init__(
+        self,
+        cluster_identifier,
+        client_name,
+        filesystem_name,
+        snapshot=None,
+        journal=None,
+        deadline=None,
+        concurrency_limit=None,
+    ):
+        # The Ceph bindings are only imported once a cluster is connected to, so rendering reports doesn't need them
+        import rados
 
-    def __init__(self, cluster_identifier, client_name, filesytem_name, mount_path):
         cluster = rados.Rados(
             name=f"client.{client_name}",
             clustername="ceph",
@@ -111,50 +410,239 @@ class CephFS_Wrapper:
             conf=dict(keyring=f"{cluster_identifier}/client.{client_name}"),
         )
         self.cluster = cluster
-        self.cluster.connect()
+        with metrics.phase("connect"):
+            self.cluster.connect()
+        self.filesystem_name = filesystem_name
+        self.snapshot = snapshot
+        self.journal = journal
+        self.deadline = deadline
+        # Shared by every mount, so the cap applies to the whole cluster
+        self.concurrency_limit = concurrency_limit
+        self.mounts = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+
+    def mount(self, mount_path):
+        # Every mount shares this cluster's single RADOS connection
+        with metrics.phase("mount"):
+            cluster_fs = CephFS_Wrapper(
+                self.cluster,
+                self.filesystem_name,
+                mount_path,
+                self.snapshot,
+                self.journal,
+                self.deadline,
+                self.concurrency_limit,
+            )
+        self.mounts.append(cluster_fs)
+        return cluster_fs
+
+    def shutdown(self):
+        for cluster_fs in self.mounts:
+            cluster_fs.unmount()
+        # A mount with a call still stuck on the MDS is left as it is, along with the cluster connection
+        abandoned = any(not cluster_fs.fs is None for cluster_fs in self.mounts)
+        self.mounts = list()
+        if not self.snapshot is None:
+            self.snapshot.close()
+            self.snapshot = None
+        if not self.journal is None:
+            self.journal.close()
+            self.journal = None
+        if not self.concurrency_limit is None:
+            metrics.count("concurrency_decreases", self.concurrency_limit.decrease_count)
+            self.concurrency_limit = None
+        if not self.cluster is None and not abandoned:
+            self.cluster.shutdown()
+        self.cluster = None
+
+    def mon_command(self, prefix):
+        ret, outbuf, outs = self.cluster.mon_command(json.dumps({"prefix": prefix, "format": "json"}), b"")
+        if ret != 0:
+            raise Exception(f"mon_command {prefix} failed: {outs}")
+        return json.loads(outbuf)
+
+    def get_pool_metadata(self):
+        # The usage, OSD map pools and CRUSH rules of the cluster, fetched once for the run
+        if self.pool_metadata is None:
+            with metrics.phase("mon_commands"):
+                self.pool_metadata = (
+                    self.mon_command("df"),
+                    self.mon_command("osd dump"),
+                    self.mon_command("osd crush rule dump"),
+                )
+        return self.pool_metadata
+
+    def get_data_protection(self, pool, erasure_code_profiles):
+        if pool.get("type") == self.ERASURE_POOL_TYPE:
+            profile = erasure_code_profiles.get(pool.get("erasure_code_profile"), dict())
+            if "k" in profile and "m" in profile:
+                return f"EC {profile['k']}+{profile['m']}"
+            return "Erasure Coded"
+        if pool.get("type") == self.REPLICATED_POOL_TYPE:
+            return f"{pool['size']}x Replicated"
+        return None
+
+    def get_rule_device_class(self, rule):
+        # Rules that take a device class take its shadow tree, named "<root>~<class>"
+        device_classes = list()
+        for step in rule.get("steps", ()):
+            item_name = step.get("item_name", "")
+            if step.get("op") == "take" and "~" in item_name:
+                device_class = item_name.split("~", 1)[1]
+                if device_class not in device_classes:
+                    device_classes.append(device_class)
+        return ",".join(device_classes) or None
+
+    def get_rados_data(self, pool_names):
+        storage_list = []
+        pools_list = []
+        df, osd_dump, crush_rules = self.get_pool_metadata()
+        for key in df["stats_by_class"]:
+            storage_row = {"storage_class": key}
+            storage_row.update(df["stats_by_class"][key])
+            storage_list.append(storage_row)
+
+        osd_pools = {pool["pool_name"]: pool for pool in osd_dump["pools"]}
+        erasure_code_profiles = osd_dump.get("erasure_code_profiles", dict())
+        rule_device_classes = {rule["rule_id"]: self.get_rule_device_class(rule) for rule in crush_rules}
+        for df_pool in df["pools"]:
+            pool_name = df_pool["name"]
+            if pool_name in pool_names:
+                pool_stats = {"name": pool_name}
+                for stat in self.POOL_STATS:
+                    pool_stats[stat] = df_pool["stats"][stat]
+                pool = osd_pools.get(pool_name, dict())
+                pool_stats["replication_factor"] = pool.get("size")
+                pool_stats["data_protection"] = self.get_data_protection(pool, erasure_code_profiles)
+                pool_stats["device_class"] = rule_device_classes.get(pool.get("crush_rule"))
+                pools_list.append(pool_stats)
+
+        return storage_list, pools_list
+
+
+class XattrReadError(Exception):
+    # An xattr that couldn't be read, as opposed to one that isn't set on the directory
+    pass
+
+
+# TODO: better class name
+class CephFS_Wrapper:
+    DIRENTRY_TYPE = {"DIR": 4, "FILE": 8, "LINK": "A"}
+    NO_DATA_AVAIL_ERROR_NUM = 61
+    # Every xattr a report row is built from, in the order they are fetched
+    REPORT_XATTRS = (
+        "ceph.quota.max_bytes",
+        "ceph.dir.rbytes",
+        "ceph.quota.max_files",
+        "ceph.dir.rfiles",
+        "ceph.dir.rctime",
+        "ceph.dir.layout.json",
+    )
+    cluster = None
+    fs = None
+
+    def __init__(
+        self, cluster, filesytem_name, mount_path, snapshot=None, journal=None, deadline=None, concurrency_limit=None
+    ):
+        import cephfs
+
+        self.cluster = cluster
         fs = cephfs.LibCephFS(rados_inst=self.cluster)
         fs.mount(bytes(mount_path.encode()), bytes(filesytem_name.encode()))
         self.fs = fs
+        self.mount_path = mount_path
+        self.snapshot = snapshot
+        self.journal = journal
+        self.deadline = deadline
+        self.concurrency_limit = concurrency_limit
+        self.call_pool = None
+        if not deadline is None:
+            # An abandoned call's slot is given back, so it doesn't hold up the calls that are still healthy
+            on_abandon = None if concurrency_limit is None else concurrency_limit.abandon
+            self.call_pool = TimedCallPool(options.scan_workers, on_abandon)
+        # Directories that timed out aren't walked into
+        self.timed_out_paths = set()
+        # Only the paths that are read more than once are cached, see cache_xattrs
+        self.cached_paths = set()
+        self.xattr_cache = dict()
 
-    def __del__(self):
+    def clear_cache(self):
+        self.cached_paths = set()
+        self.xattr_cache = dict()
+
+    def cache_xattrs(self, paths):
+        # Keeps the xattrs of paths once they are read, until drop_xattrs. Report paths that are
+        # also listed under their parent are only fetched once this way, while the cache stays
+        # the size of the list of report paths rather than the directory tree.
+        self.cached_paths.update(os.path.normpath(path) for path in paths)
+
+    def drop_xattrs(self, path):
+        cache_key = os.path.normpath(path)
+        self.cached_paths.discard(cache_key)
+        self.xattr_cache.pop(cache_key, None)
+
+    def unmount(self):
+        if not self.call_pool is None and self.call_pool.has_abandoned_calls():
+            # Unmounting would wait on the calls that are stuck, the process exiting cleans up instead
+            print(f"Error unmounting {self.mount_path}\n\tError : calls to the MDS are still running\n")
+            return
         if not self.fs is None:
             self.fs.unmount()
             self.fs.shutdown()
-        if not self.cluster is None:
-            self.cluster.shutdown()
+            self.fs = None
 
-    def get_xattr(self, path, xattr):
-        bytepath = bytes(path.encode())
-        try:
-            value = self.fs.getxattr(bytepath, xattr).decode()
-            return value
-        except Exception as e:
-            # Error code for "No xattr data for this path"
-            if e.args[0] != self.NO_DATA_AVAIL_ERROR_NUM:
-                # Real Error, log it
-                print(f"Error on path {path}\n\tError : {e}\n")
-            return ""
-
-    def get_quota_usage_entry(self, path, key_prefix, quota_xattr, usage_xattr):
-        bytepath = bytes(path.encode())
-        quota_key = f"{key_prefix}_quota"
-        usage_key = f"{key_prefix}_used"
-        percent_key = f"{key_prefix}_percent"
-        try:
-            quota_val = int(self.fs.getxattr(bytepath, quota_xattr))
-            usage_val = int(self.fs.getxattr(bytepath, usage_xattr))
-            if quota_val and quota_val > 0:
-                usage_percent = round(((usage_val / quota_val) * 100), 2)
-            else:
-                quota_val = "-"
-                usage_percent = "-"
-            return {quota_key: quota_val, usage_key: usage_val, percent_key: usage_percent}
-        except Exception as e:
-            # Error code for "No xattr data for this path"
-            if e.args[0] != self.NO_DATA_AVAIL_ERROR_NUM:
-                # Real Error, log it
-                print(f"Error on path {path}\n\tError : {e}\n")
-            return None
+    def get_xattr_values(self, path):
+        # The xattr values read so far of path, which only outlive the caller for cached paths
+        cache_key = os.path.normpath(path)
+        values = self.xattr_cache.get(cache_key)
+        if values is None:
+            values = dict()
+            if cache_key in self.cached_paths:
+                self.xattr_cache[cache_key] = values
+        return values
+
+    def get_xattrs(self, path, xattrs, values=None):
+        # Returns None if one of the xattrs isn't set, and raises XattrReadError if one couldn't be read.
+        # The values already in values (from get_xattr_values) aren't read again.
+        if values is None:
+            values = self.get_xattr_values(path)
+
+        bytepath = bytes(os.path.normpath(path).encode())
+        for xattr in xattrs:
+            if xattr not in values:
+                try:
+                    values[xattr] = self.call_mds(f"getxattr {xattr}", self.fs.getxattr, bytepath, xattr).decode()
+                except concurrent.futures.TimeoutError:
+                    # No concurrency slot came free in time, which isn't an error of the path
+                    raise
+                except Exception as e:
+                    # Error code for "No xattr data for this path"
+                    if not e.args or e.args[0] != self.NO_DATA_AVAIL_ERROR_NUM:
+                        # Real Error, log it. It isn't cached, so the xattr is read again next time.
+                        print(f"Error on path {path}\n\tError : {e}\n")
+                        metrics.count("errored")
+                        raise XattrReadError(path) from e
+                    values[xattr] = None
+            # Every xattr in the set is needed, so stop at the first one that is missing
+            if values[xattr] is None:
+                return None
+
+        return [values[xattr] for xattr in xattrs]
+
+    def get_quota_usage_entry(self, quota_value, usage_value):
+        quota_val = int(quota_value)
+        usage_val = int(usage_value)
+        if quota_val and quota_val > 0:
+            usage_percent = round(((usage_val / quota_val) * 100), 2)
+        else:
+            quota_val = QuotaRow.NO_QUOTA
+            usage_percent = QuotaRow.NO_QUOTA
+        return quota_val, usage_val, usage_percent
 
     def bytes_to_gibibytes(byte_count):
         return round((byte_count / math.pow(1024, 3)), 2)
@@ -163,114 +651,666 @@ class CephFS_Wrapper:
         return round((byte_count / math.pow(1024, 4)), 2)
 
     def get_report_entry(self, path):
-        row = {"path": path}
+        try:
+            return self.get_timed_report_entry(path)
+        except XattrReadError:
+            # Left out of this run's report, but neither journaled nor put in the snapshot as a
+            # directory without a report entry, so it's read again on the next (or resumed) run
+            return None
 
-        bytes_entry = self.get_quota_usage_entry(path, "bytes", "ceph.quota.max_bytes", "ceph.dir.rbytes")
-        files_entry = self.get_quota_usage_entry(path, "files", "ceph.quota.max_files", "ceph.dir.rfiles")
-        rctime = round(float(self.get_xattr(path, "ceph.dir.rctime")))
-        dir_backing_pool = json.loads(self.get_xattr(path, "ceph.dir.layout.json"))["pool_name"]
+    def get_timed_report_entry(self, path):
+        if self.deadline is None:
+            return self.get_journaled_report_entry(path)
+        if self.deadline.expired():
+            metrics.count("unscanned")
+            return self.get_last_report_entry(path, QuotaRow.UNSCANNED)
+        try:
+            return self.call_pool.call(self.deadline.get_timeout(), self.get_journaled_report_entry, path)
+        except concurrent.futures.TimeoutError:
+            # The call stops at its next MDS call (see call_mds), so its row is only journaled (and put in
+            # the snapshot) if it was stuck on its last one. Otherwise it's read again on the next run.
+            if self.deadline.expired():
+                metrics.count("unscanned")
+                return self.get_last_report_entry(path, QuotaRow.UNSCANNED)
+            print(f"Error on path {path}\n\tError : timed out after {self.deadline.call_timeout} seconds\n")
+            metrics.count("timed_out")
+            self.timed_out_paths.add(path)
+            return self.get_last_report_entry(path, QuotaRow.TIMED_OUT)
 
-        # Gibibyte conversion for byte quota and usage
-        if bytes_entry:
-            if bytes_entry["bytes_quota"] != "-":
-                bytes_entry["bytes_quota"] = CephFS_Wrapper.bytes_to_gibibytes(int(bytes_entry["bytes_quota"]))
-            bytes_entry["bytes_used"] = CephFS_Wrapper.bytes_to_gibibytes(int(bytes_entry["bytes_used"]))
-
-        last_modified_date = None
-        if rctime and not rctime is "":
-            last_modified_date = datetime.datetime.utcfromtimestamp(rctime).strftime("%Y-%m-%d")
-
-        if not None in (bytes_entry, files_entry, last_modified_date):
-            row.update(bytes_entry)
-            row.update(files_entry)
-            row["last_modified_date"] = last_modified_date
-            row["backing_pool"] = dir_backing_pool
+    def get_last_report_entry(self, path, scan_status):
+        # The row from the snapshot, marked with why it wasn't read on this run. A directory that
+        # isn't in the snapshot (e.g. a new one) is still reported, without any values.
+        known, last_row = False, None
+        if not self.snapshot is None:
+            known, last_row = self.snapshot.get_last(os.path.normpath(os.path.join(self.mount_path, path)))
+        if not known:
+            return QuotaRow.unread(path, scan_status)
+        return QuotaRow(path, *last_row, scan_status=scan_status) if last_row else None
+
+    def get_journaled_report_entry(self, path):
+        if self.journal is None:
+            return self.scan_report_entry(path)
+        # A resumed run doesn't scan a directory again that the interrupted run already finished
+        journal_path = os.path.normpath(os.path.join(self.mount_path, path))
+        journaled, journal_row = self.journal.get(journal_path)
+        if journaled:
+            metrics.count("resumed")
+            return QuotaRow(path, *journal_row) if journal_row else None
+        # Only reached if every xattr was read (or isn't set), a read error raises past the journal
+        row = self.scan_report_entry(path)
+        self.journal.put(journal_path, row.to_tuple()[1:] if row else None)
+        return row
+
+    def scan_report_entry(self, path):
+        if not self.snapshot is None:
+            # Reuse the last run's row for a directory that hasn't changed since then
+            values = self.get_xattr_values(path)
+            rctime_value = self.get_xattrs(path, ("ceph.dir.rctime",), values)
+            if rctime_value is None:
+                return None
+            snapshot_path = os.path.normpath(os.path.join(self.mount_path, path))
+            unchanged, snapshot_row = self.snapshot.get(snapshot_path, rctime_value[0])
+            if unchanged:
+                metrics.count("skipped")
+                return QuotaRow(path, *snapshot_row) if snapshot_row else None
+            row = self.read_report_entry(path, values)
+            self.snapshot.put(snapshot_path, rctime_value[0], row.to_tuple()[1:] if row else None)
             return row
-        else:
+        return self.read_report_entry(path)
+
+    def read_report_entry(self, path, values=None):
+        xattr_values = self.get_xattrs(path, self.REPORT_XATTRS, values)
+        if xattr_values is None:
+            metrics.count("no_data")
             return None
+        metrics.count("scanned")
+        max_bytes, rbytes, max_files, rfiles, rctime, layout = xattr_values
 
-    def get_report_entries_dir(self, path):
-        dr = self.fs.opendir(bytes(path.encode()))
+        bytes_quota, bytes_used, bytes_percent = self.get_quota_usage_entry(max_bytes, rbytes)
+        files_quota, files_used, files_percent = self.get_quota_usage_entry(max_files, rfiles)
+        last_modified_date = datetime.datetime.utcfromtimestamp(round(float(rctime))).strftime("%Y-%m-%d")
+        dir_backing_pool = json.loads(layout)["pool_name"]
 
-        entries = list()
+        # Gibibyte conversion for byte quota and usage
+        if bytes_quota is not QuotaRow.NO_QUOTA:
+            bytes_quota = CephFS_Wrapper.bytes_to_gibibytes(bytes_quota)
+        bytes_used = CephFS_Wrapper.bytes_to_gibibytes(bytes_used)
 
-        dir_entry = self.fs.readdir(dr)
+        return QuotaRow(
+            path,
+            bytes_quota,
+            bytes_used,
+            bytes_percent,
+            files_quota,
+            files_used,
+            files_percent,
+            last_modified_date,
+            dir_backing_pool,
+        )
 
-        while dir_entry:
-            subdir_name = bytes(dir_entry.d_name).decode()
-            if dir_entry.d_type is self.DIRENTRY_TYPE["DIR"] and b"." not in dir_entry.d_name:
-                subdir_path = os.path.join(path, subdir_name, "")
-                row = self.get_report_entry(subdir_path)
-                if row:
-                    entries.append(row)
+    def call_mds(self, call_name, func, *args):
+        # Times a call to the MDS, which holds one of the cluster's concurrency slots while it runs.
+        # With a deadline, waiting for a slot raises concurrent.futures.TimeoutError once the timeout
+        # of the timed call this is part of passes, or otherwise once the scan budget runs out.
+        # A timed call that was given up on stops at its next call rather than going on in the background.
+        start_time = None
+        owner = None
+        if not self.deadline is None:
+            owner = self.call_pool.get_current_call()
+            if not owner is None and self.call_pool.is_abandoned(owner):
+                raise concurrent.futures.TimeoutError()
+        if not self.concurrency_limit is None:
+            timeout = None
+            if not self.deadline is None:
+                timeout = self.deadline.get_remaining() if owner is None else self.deadline.get_timeout()
+            start_time = self.concurrency_limit.acquire(timeout, owner)
+            if start_time is None:
+                raise concurrent.futures.TimeoutError()
+        call_start = time.perf_counter()
+        failed = False
+        try:
+            return func(*args)
+        except Exception as e:
+            # A missing xattr is an answer like any other, not a sign of an overloaded MDS
+            failed = not e.args or e.args[0] != self.NO_DATA_AVAIL_ERROR_NUM
+            raise
+        finally:
+            metrics.observe_latency(call_name, time.perf_counter() - call_start)
+            if not start_time is None:
+                self.concurrency_limit.release(start_time, failed, owner)
 
-            dir_entry = self.fs.readdir(dr)
+    def iter_last_subdir_paths(self, path):
+        # Directories that can't be listed anymore are reported with their last known rows
+        if not self.snapshot is None:
+            snapshot_path = os.path.normpath(os.path.join(self.mount_path, path))
+            for subdir_path in self.snapshot.get_last_subdirs(snapshot_path):
+                yield os.path.join(path, os.path.basename(subdir_path), "")
 
-        self.fs.closedir(dr)
-        sort_function = lambda x: x[options.sort_by] if not x[options.sort_by] is "-" else None
-        return sorted(entries, key=sort_function, reverse=options.sort_reverse)
+    def call_listing(self, call_name, func, *args):
+        # The calls listing a directory are timed like the reads of a directory's xattrs
+        if self.deadline is None:
+            return self.call_mds(call_name, func, *args)
+        return self.call_pool.call(self.deadline.get_timeout(), self.call_mds, call_name, func, *args)
 
-    def get_rados_data(self, pool_names):
-        storage_list = []
-        pools_list = []
-        command = self.cluster.mon_command(json.dumps({"prefix": "df", "format": "json"}), b"")
-        ob = json.loads(command[1])
-        for key in ob["stats_by_class"]:
-            storage_row = {"storage_class": key}
-            storage_row.update(ob["stats_by_class"][key])
-            storage_list.append(storage_row)
+    def iter_subdir_paths(self, path):
+        if not self.deadline is None and self.deadline.expired():
+            yield from self.iter_last_subdir_paths(path)
+            return
+        dr = None
+        # Only kept with a deadline, for a listing that has to be finished from the snapshot
+        listed_paths = set()
+        try:
+            dr = self.call_listing("opendir", self.fs.opendir, bytes(path.encode()))
+            dir_entry = self.call_listing("readdir", self.fs.readdir, dr)
 
-        for pool_i in range(len(ob["pools"])):
-            pool_name = ob["pools"][pool_i]["name"]
-            if pool_name in pool_names:
-                pool_stats = {"name": pool_name}
-                for stat in self.POOL_STATS:
-                    pool_stats[stat] = ob["pools"][pool_i]["stats"][stat]
-                pools_list.append(pool_stats)
+            while dir_entry:
+                subdir_name = bytes(dir_entry.d_name).decode()
+                if dir_entry.d_type is self.DIRENTRY_TYPE["DIR"] and b"." not in dir_entry.d_name:
+                    subdir_path = os.path.join(path, subdir_name, "")
+                    if not self.deadline is None:
+                        listed_paths.add(subdir_path)
+                    yield subdir_path
 
-        return storage_list, pools_list
+                if not self.deadline is None and self.deadline.expired():
+                    break
+                dir_entry = self.call_listing("readdir", self.fs.readdir, dr)
+            if not dir_entry:
+                return
+        except concurrent.futures.TimeoutError:
+            if not self.deadline.expired():
+                print(f"Error listing {path}\n\tError : timed out after {self.deadline.call_timeout} seconds\n")
+                metrics.count("listing_timed_out")
+            # The call that timed out may still be using the directory handle, so it's left open
+            dr = None
+        finally:
+            if not dr is None:
+                self.fs.closedir(dr)
+        # The scan budget ran out or a listing call timed out, so the rest of the listing is taken from the snapshot
+        for subdir_path in self.iter_last_subdir_paths(path):
+            if subdir_path not in listed_paths:
+                yield subdir_path
+
+    def scan_subdir(self, path, descend):
+        row = self.get_report_entry(path)
+        if descend and not self.deadline is None:
+            descend = not self.deadline.expired() and path not in self.timed_out_paths
+        if descend:
+            # Only directories that have sub-directories of their own are worth opening on the next level
+            try:
+                subdirs = self.get_xattrs(path, ("ceph.dir.subdirs",))
+            except (XattrReadError, concurrent.futures.TimeoutError):
+                subdirs = None
+            descend = not subdirs is None and int(subdirs[0]) > 0
+        return row, descend
+
+    def get_sorted_report_entries(self, scan_map, subdir_paths, descend, next_parents, chunk_size):
+        # Yields the rows of subdir_paths in sorted order. The paths are scanned and sorted chunk_size
+        # at a time, and when there is more than one chunk, the sorted chunks are spilled to temporary
+        # files and merged, so memory use is bounded by the chunk size.
+        scan = partial(self.scan_subdir, descend=descend)
+
+        with ExitStack() as stack:
+            sorted_chunks = SortedRowChunks(stack)
+            while True:
+                chunk_paths = list(itertools.islice(subdir_paths, chunk_size))
+                if not chunk_paths:
+                    break
+                sorted_chunks.add(get_scanned_rows(chunk_paths, scan_map(scan, chunk_paths), next_parents))
+            yield from sorted_chunks
+
+    def get_report_entries_dir(self, path, workers=1, chunk_size=None, depth=1, exclude_paths=()):
+        # Yields the rows of the sub-directories of path, walking the tree breadth first down to depth
+        # levels below path, with each level's rows in sorted order. Directories below the first level
+        # only have rows if they have a quota, and directories in exclude_paths (which are reported on
+        # separately) are not walked into.
+        for level, row in self.get_report_entry_levels(path, workers, chunk_size, depth, exclude_paths):
+            yield row
+
+    def get_report_entry_levels(self, path, workers=1, chunk_size=None, depth=1, exclude_paths=(), shard=None):
+        # Yields the rows of get_report_entries_dir along with their level. With a shard, only the
+        # first level sub-directories in the shard (and the directories underneath them) are walked.
+        chunk_size = chunk_size or options.sort_chunk_size
+
+        with ExitStack() as stack:
+            scan_map = map
+            if workers > 1:
+                # The getxattr calls release the GIL while waiting on the MDS, so the subdirectories can
+                # share this mount across a pool of threads, which also bounds the requests in flight
+                scan_map = stack.enter_context(ThreadPoolExecutor(max_workers=workers)).map
+
+            parents = [path]
+            for level in range(1, depth + 1):
+                next_parents = list()
+                subdir_paths = itertools.chain.from_iterable(map(self.iter_subdir_paths, parents))
+                if level == 1 and not shard is None:
+                    subdir_paths = (subdir_path for subdir_path in subdir_paths if is_in_shard(subdir_path, shard))
+                rows = self.get_sorted_report_entries(scan_map, subdir_paths, level < depth, next_parents, chunk_size)
+                for row in rows:
+                    if level == 1 or row.has_quota():
+                        yield level, row
+                parents = [parent for parent in next_parents if os.path.normpath(parent) not in exclude_paths]
+                if not parents:
+                    break
+
+
+class AsyncCephCluster:
+    # Runs the blocking calls for one cluster on a shared executor from the event loop, with at most
+    # workers of them in flight at a time
+    def __init__(self, ceph_cluster, executor, workers):
+        # Like the Ceph bindings, asyncio (and everything else only some modes need) is imported
+        # where it's used, so that e.g. rendering reports starts quickly
+        import asyncio
+
+        self.ceph_cluster = ceph_cluster
+        self.executor = executor
+        self.semaphore = asyncio.Semaphore(workers)
+        self.pending = set()
+
+    async def run(self, func, *args):
+        import asyncio
+
+        future = self.executor.submit(func, *args)
+        self.pending.add(future)
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            # A call that was cancelled can still be running, and is waited for in wait_pending
+            if future.done():
+                self.pending.discard(future)
+
+    async def call(self, func, *args):
+        async with self.semaphore:
+            return await self.run(func, *args)
+
+    def wait_pending(self):
+        concurrent.futures.wait(list(self.pending))
+
+    async def mount(self, mount_path):
+        return AsyncCephFS_Wrapper(self, await self.run(self.ceph_cluster.mount, mount_path))
 
 
-def write_to_file(filename, header, rows):
-    with open(filename, "w", newline="") as csvfile:
-        writer = csv.writer(csvfile, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
-        writer.writerow(header)
+class AsyncCephFS_Wrapper:
+    # The async counterpart of a CephFS_Wrapper, whose calls run through its cluster's AsyncCephCluster
+    def __init__(self, async_cluster, cluster_fs):
+        self.async_cluster = async_cluster
+        self.cluster_fs = cluster_fs
+
+    async def get_report_entry(self, path):
+        return await self.async_cluster.call(self.cluster_fs.get_report_entry, path)
+
+    async def list_subdir_paths(self, path):
+        return await self.async_cluster.call(lambda: list(self.cluster_fs.iter_subdir_paths(path)))
+
+    async def scan_subdirs(self, subdir_paths, descend, next_parents):
+        import asyncio
+
+        scan = partial(self.cluster_fs.scan_subdir, descend=descend)
+        scans = await asyncio.gather(*(self.async_cluster.call(scan, subdir_path) for subdir_path in subdir_paths))
+        return get_scanned_rows(subdir_paths, scans, next_parents)
+
+    async def get_report_entries_dir(self, path, chunk_size=None, depth=1, exclude_paths=()):
+        # The same rows in the same order as CephFS_Wrapper.get_report_entries_dir, with each
+        # chunk of sub-directories scanned concurrently
+        chunk_size = chunk_size or options.sort_chunk_size
+
+        parents = [path]
+        for level in range(1, depth + 1):
+            next_parents = list()
+            with ExitStack() as stack:
+                sorted_chunks = SortedRowChunks(stack)
+                chunk_paths = list()
+                for parent in parents:
+                    chunk_paths.extend(await self.list_subdir_paths(parent))
+                    while len(chunk_paths) >= chunk_size:
+                        rows = await self.scan_subdirs(chunk_paths[:chunk_size], level < depth, next_parents)
+                        sorted_chunks.add(rows)
+                        del chunk_paths[:chunk_size]
+                if chunk_paths:
+                    rows = await self.scan_subdirs(chunk_paths, level < depth, next_parents)
+                    sorted_chunks.add(rows)
+                for row in sorted_chunks:
+                    if level == 1 or row.has_quota():
+                        yield row
+            parents = [parent for parent in next_parents if os.path.normpath(parent) not in exclude_paths]
+            if not parents:
+                break
+
+
+def get_scanned_rows(subdir_paths, scans, next_parents):
+    # Returns the rows of the scanned sub-directories, adding the ones to descend into to next_parents
+    rows = list()
+    for subdir_path, (row, subdir_descend) in zip(subdir_paths, scans):
+        if row:
+            rows.append(row)
+        if subdir_descend:
+            next_parents.append(subdir_path)
+    return rows
+
+
+class SortedRowChunks:
+    # Sorts rows a chunk at a time, and when there is more than one chunk, spills the sorted chunks
+    # to temporary files (closed with stack) to be merged when iterated over, so memory use is
+    # bounded by the chunk size
+    def __init__(self, stack):
+        self.stack = stack
+        self.sort_key = QuotaRow.sort_key(options.sort_by)
+        self.spilled_chunks = list()
+        self.sorted_chunk = None
+
+    def add(self, rows):
+        if not self.sorted_chunk is None:
+            chunk_file = self.stack.enter_context(tempfile.TemporaryFile())
+            write_row_stream(chunk_file, self.sorted_chunk)
+            chunk_file.seek(0)
+            self.spilled_chunks.append(read_row_stream(chunk_file))
+        self.sorted_chunk = sorted(rows, key=self.sort_key, reverse=options.sort_reverse)
+
+    def __iter__(self):
+        if self.sorted_chunk is None:
+            return iter(())
+        if not self.spilled_chunks:
+            return iter(self.sorted_chunk)
+        # heapq.merge keeps equal rows in chunk order, so this is the same order as one stable sort
+        return heapq.merge(
+            *self.spilled_chunks, iter(self.sorted_chunk), key=self.sort_key, reverse=options.sort_reverse
+        )
+
+
+def write_row_stream(f, rows):
+    for row in rows:
+        pickle.dump(row.to_tuple(QuotaRow.__slots__), f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_row_stream(f):
+    while True:
+        try:
+            yield QuotaRow(*pickle.load(f))
+        except EOFError:
+            return
+
+
+def read_row_stream_file(filename):
+    with open(filename, "rb") as f:
+        yield from read_row_stream(f)
+
+
+def write_segment_stream(f, segment_rows):
+    for segment, row in segment_rows:
+        pickle.dump((segment, row.to_tuple(QuotaRow.__slots__)), f, pickle.HIGHEST_PROTOCOL)
+
+
+def read_segment_stream_file(filename):
+    with open(filename, "rb") as f:
+        while True:
+            try:
+                segment, values = pickle.load(f)
+            except EOFError:
+                return
+            yield segment, QuotaRow(*values)
+
+
+def merge_segment_streams(segment_streams):
+    # Merges streams of (segment, row) from get_quota_row_segments into the rows of one scan, in order
+    sort_key = QuotaRow.sort_key(options.sort_by)
+    segment_iters = [itertools.groupby(stream, key=operator.itemgetter(0)) for stream in segment_streams]
+    heads = [next(segment_iter, None) for segment_iter in segment_iters]
+    while any(heads):
+        segment = min(head[0] for head in heads if head)
+        segment_rows = [map(operator.itemgetter(1), head[1]) for head in heads if head and head[0] == segment]
+        yield from heapq.merge(*segment_rows, key=sort_key, reverse=options.sort_reverse)
+        # Each merged group has been used up, so its stream can move on to its next segment
+        for i, head in enumerate(heads):
+            if head and head[0] == segment:
+                heads[i] = next(segment_iters[i], None)
+
+
+def get_row_values(row, fields):
+    if isinstance(row, QuotaRow):
+        return row.to_tuple(fields)
+    elif isinstance(row, dict):
+        return tuple(row.values())
+    return row
+
+
+def write_to_file(filename, header, rows, fields=None, export_formats=()):
+    # Writes the CSV report file, and the same rows to a file of each of the export formats (named
+    # like the CSV file, with the format's extension). Dict rows are written with their keys as fields,
+    # QuotaRows with QuotaRow.FIELDS unless fields are given, and any other table with its header.
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if isinstance(first_row, dict):
+        fields = tuple(first_row.keys())
+    elif fields is None:
+        fields = QuotaRow.FIELDS if isinstance(first_row, QuotaRow) else tuple(header)
+    rows = itertools.chain([first_row], rows) if not first_row is None else rows
+
+    # The rows are written to temporary files that are only renamed once every row was written,
+    # so a run that is interrupted never leaves a partial report behind under the report's name
+    filenames = [(CSVReportWriter, filename)]
+    for export_format in export_formats:
+        filenames.append((EXPORT_WRITERS[export_format], f"{os.path.splitext(filename)[0]}.{export_format}"))
+    with ExitStack() as stack:
+        writers = [
+            stack.enter_context(writer_class(f"{writer_filename}.tmp", header, fields))
+            for writer_class, writer_filename in filenames
+        ]
         for row in rows:
-            if isinstance(row, tuple):
-                writer.writerow(row)
-            elif isinstance(row, dict):
-                writer.writerow(row.values())
+            values = get_row_values(row, fields)
+            for writer in writers:
+                writer.write(values)
+    for writer_class, writer_filename in filenames:
+        os.replace(f"{writer_filename}.tmp", writer_filename)
 
 
-def get_quota_rows(cluster_fs, cluster_name, mount_path):
-    rows = []
-    toplevel_quota_usages = []
-    subdir_quota_usages = []
+def get_mount_report_paths(cluster_name, mount_path):
+    report_paths = list()
     for path in options.report_dirs[cluster_name]:
         if os.path.commonpath([mount_path, path]) == mount_path:
-            mount_relative_path = os.path.relpath(path, mount_path)
-            toplevel_entry = cluster_fs.get_report_entry(mount_relative_path)
-            if toplevel_entry:
-                toplevel_entry["path"] = path
-                toplevel_quota_usages.append(toplevel_entry)
-            dir_entries = cluster_fs.get_report_entries_dir(mount_relative_path)
-            for entry in dir_entries:
-                entry["path"] = os.path.normpath(os.path.join(mount_path, entry["path"]))
-            subdir_quota_usages.extend(dir_entries)
-
-    rows.extend(toplevel_quota_usages)
-
-    nonduplicate_subdir_usages = list(row for row in subdir_quota_usages if row not in toplevel_quota_usages)
-    rows.extend(nonduplicate_subdir_usages)
-    return rows
+            report_paths.append(path)
+    return report_paths
+
+
+def is_in_shard(path, shard):
+    # Directories are spread over the shards by a hash of their path, which is the same on every host
+    index, count = shard
+    return zlib.crc32(os.path.normpath(path).encode()) % count == index
+
+
+def get_quota_rows(cluster_fs, cluster_name, mount_path):
+    for segment, row in get_quota_row_segments(cluster_fs, cluster_name, mount_path):
+        yield row
 
 
-def get_storage_and_pool_data(cluster_fs, pool_names):
-    storage_data, pool_data = cluster_fs.get_rados_data(pool_names)
-    for row in pool_data:
-        pool_id = cluster_fs.fs.get_pool_id(row["name"])
-        row["replication_factor"] = cluster_fs.fs.get_pool_replication(pool_id)
+def get_quota_row_segments(cluster_fs, cluster_name, mount_path, mount_index=0, shard=None):
+    # Yields the rows of get_quota_rows, each with the segment of the report it belongs to: either
+    # (mount_index, 0, report path index) for a top level directory or (mount_index, 1, report path
+    # index, level) for the directories under one. Each segment is sorted, so the rows of several
+    # shards can be merged back into the order of one scan.
+    report_paths = get_mount_report_paths(cluster_name, mount_path)
 
+    # Sub-directories that are also reported on as top level directories are only listed once
+    toplevel_paths = set(os.path.normpath(path) for path in report_paths)
+    cluster_fs.cache_xattrs(os.path.relpath(path, mount_path) for path in report_paths)
+    for i, path in enumerate(report_paths):
+        if not shard is None and not is_in_shard(path, shard):
+            continue
+        toplevel_entry = cluster_fs.get_report_entry(os.path.relpath(path, mount_path))
+        if toplevel_entry:
+            toplevel_entry.path = path
+            yield (mount_index, 0, i), toplevel_entry
+
+    # Walking deeper than one level never walks into another reported directory, so no directory is listed twice
+    report_relative_paths = set(os.path.normpath(os.path.relpath(path, mount_path)) for path in report_paths)
+    for i, path in enumerate(report_paths):
+        entries = cluster_fs.get_report_entry_levels(
+            os.path.relpath(path, mount_path),
+            options.scan_workers,
+            depth=options.depth,
+            exclude_paths=report_relative_paths,
+            shard=shard,
+        )
+        for level, entry in entries:
+            entry.path = os.path.normpath(os.path.join(mount_path, entry.path))
+            if entry.path not in toplevel_paths:
+                yield (mount_index, 1, i, level), entry
+            else:
+                cluster_fs.drop_xattrs(os.path.relpath(entry.path, mount_path))
+
+
+async def get_quota_rows_async(async_fs, cluster_name, mount_path):
+    # The same rows in the same order as get_quota_rows, scanned through an AsyncCephFS_Wrapper
+    import asyncio
+
+    report_paths = get_mount_report_paths(cluster_name, mount_path)
+
+    async_fs.cluster_fs.cache_xattrs(os.path.relpath(path, mount_path) for path in report_paths)
+    toplevel_entries = await asyncio.gather(
+        *(async_fs.get_report_entry(os.path.relpath(path, mount_path)) for path in report_paths)
+    )
+    toplevel_paths = set(os.path.normpath(path) for path in report_paths)
+    for path, toplevel_entry in zip(report_paths, toplevel_entries):
+        if toplevel_entry:
+            toplevel_entry.path = path
+            yield toplevel_entry
+
+    report_relative_paths = set(os.path.normpath(os.path.relpath(path, mount_path)) for path in report_paths)
+    for path in report_paths:
+        entries = async_fs.get_report_entries_dir(
+            os.path.relpath(path, mount_path), depth=options.depth, exclude_paths=report_relative_paths
+        )
+        async for entry in entries:
+            entry.path = os.path.normpath(os.path.join(mount_path, entry.path))
+            if entry.path not in toplevel_paths:
+                yield entry
+            else:
+                async_fs.cluster_fs.drop_xattrs(os.path.relpath(entry.path, mount_path))
+
+
+def iterate_in_thread(rows, loop, stopped):
+    # Iterates over the async iterator rows from a thread other than loop's. If stopped is set first,
+    # this raises CancelledError, so the rows of an interrupted scan are never taken for a whole report.
+    import asyncio
+
+    while True:
+        if stopped.is_set():
+            raise concurrent.futures.CancelledError()
+        try:
+            yield asyncio.run_coroutine_threadsafe(rows.__anext__(), loop).result()
+        except StopAsyncIteration:
+            return
+
+
+class QuotaTableCollector:
+    # Collects the backing pools and the report email's table from the stream of quota rows. With a
+    # top_n, only the top_n rows by top_by are kept (in a bounded heap) for the email, otherwise every
+    # row is, so this is the part of a run (besides the snapshot and history) that grows with the report.
+    def __init__(self, fields, top_n=None, top_by="bytes_used"):
+        self.fields = fields
+        self.top_n = top_n
+        self.top_by = top_by
+        self.sort_key = QuotaRow.sort_key(top_by)
+        self.backing_pools = set()
+        self.row_count = 0
+        self.stale_count = 0
+        self.table_rows = list()
+
+    def collect(self, rows):
+        for row in rows:
+            if not row.backing_pool is None:
+                self.backing_pools.add(row.backing_pool)
+            if not row.scan_status is None:
+                self.stale_count += 1
+            if self.top_n is None:
+                self.table_rows.append(row.to_tuple(self.fields))
+            elif self.top_n > 0:
+                # Earlier rows win ties, and the unique row count means the values are never compared
+                entry = (self.sort_key(row), -self.row_count, row.to_tuple(self.fields))
+                if len(self.table_rows) < self.top_n:
+                    heapq.heappush(self.table_rows, entry)
+                elif entry > self.table_rows[0]:
+                    heapq.heapreplace(self.table_rows, entry)
+            self.row_count += 1
+            yield row
+
+    def get_table_rows(self):
+        if self.top_n is None:
+            return self.table_rows
+        return [entry[-1] for entry in sorted(self.table_rows, reverse=True)]
+
+    def get_description(self):
+        descriptions = list()
+        if self.stale_count:
+            descriptions.append(
+                f"{self.stale_count} directories couldn't be scanned in time and show their last known values"
+                " (or none, if there aren't any), see the Scan Status column."
+            )
+        if not self.top_n is None and self.row_count > self.top_n:
+            top_by = QuotaRow.COLUMNS[self.top_by]
+            descriptions.append(
+                f"Showing the top {self.top_n} of {self.row_count} directories by {top_by},"
+                " see the attachment for the full table."
+            )
+        return " ".join(descriptions) or None
+
+
+def get_journal_filename(cluster, shard=None):
+    if not options.journal_pattern:
+        return None
+    if shard is None:
+        return create_filename(cluster, options.journal_pattern, "journal")
+    # Shards on other hosts may share the directory, so each one has its own journal
+    return create_filename(cluster, f"{options.journal_pattern}_Shard_{shard[0]}_of_{shard[1]}", "journal")
+
+
+def remove_journal_files(cluster):
+    # Once the report files are written, nothing is left to resume
+    journal_re = re.compile(
+        re.escape(f"{cluster}_{options.journal_pattern}_")
+        + r"(Shard_\d+_of_\d+_)?"
+        + re.escape(f"{datetime.date.today()}.journal")
+    )
+    for filename in os.listdir("."):
+        if journal_re.fullmatch(filename):
+            os.remove(filename)
+
+
+def create_scan_deadline():
+    if not options.scan_deadlines:
+        return None
+    return ScanDeadline(options.scan_budget, options.call_timeout)
+
+
+def connect_to_cluster(cluster, journal_filename=None, deadline=None):
+    snapshot = None
+    if options.snapshot_file:
+        from quota_snapshot import QuotaSnapshot
+
+        snapshot = QuotaSnapshot(options.snapshot_file, cluster, options.full_scan)
+    journal = None
+    if journal_filename:
+        journal = QuotaScanJournal(journal_filename, options.resume)
+    concurrency_limit = None
+    if options.latency_target:
+        max_concurrency = options.concurrency_caps.get(cluster, options.scan_workers)
+        concurrency_limit = AdaptiveConcurrencyLimit(options.latency_target, max_concurrency)
+    client_name = options.cluster_clients[cluster]
+    return CephCluster(
+        cluster, client_name, options.filesystem_names[cluster], snapshot, journal, deadline, concurrency_limit
+    )
+
+
+def write_mount_quota_rows(cluster, mount_path, part_filename):
+    # Returns this worker's metrics for the parent process to merge into the run's
+    metrics.reset()
+    ceph_cluster = connect_to_cluster(cluster, get_journal_filename(cluster), create_scan_deadline())
+    with ceph_cluster, open(part_filename, "wb") as part_file:
+        quota_rows = get_quota_rows(ceph_cluster.mount(mount_path), cluster, mount_path)
+        write_row_stream(part_file, metrics.timed_iter("scan", quota_rows))
+    return metrics.to_dict()
+
+
+def get_storage_and_pool_data(ceph_cluster, pool_names):
+    storage_data, pool_data = ceph_cluster.get_rados_data(pool_names)
     for row in storage_data + pool_data:
         for key in row:
             if isinstance(row[key], float):
@@ -281,30 +1321,121 @@ def get_storage_and_pool_data(cluster_fs, pool_names):
     return storage_data, pool_data
 
 
-def create_filename(cluster, pattern):
-    return f"{cluster}_{pattern}_{datetime.date.today()}.csv"
+def get_report_date():
+    # Today, unless rendering the reports of an earlier day
+    return options.report_date or datetime.date.today()
+
+
+def create_filename(cluster, pattern, extension="csv"):
+    return f"{cluster}_{pattern}_{get_report_date()}.{extension}"
+
+
+def find_previous_report_file(cluster, pattern):
+    # The newest report file written on an earlier day, if there is one
+    filename = create_filename(cluster, pattern)
+    filename_re = re.compile(re.escape(f"{cluster}_{pattern}_") + r"\d{4}-\d{2}-\d{2}\.csv")
+    previous_filenames = [name for name in os.listdir(".") if filename_re.fullmatch(name) and name < filename]
+    return max(previous_filenames, default=None)
+
+
+def get_shard_filename(cluster, shard):
+    index, count = shard
+    return os.path.join(options.shard_dir, create_filename(cluster, f"Shard_{index}_of_{count}", "part"))
+
+
+def write_cluster_shard(cluster, shard):
+    # Scans this shard's part of every mount of the cluster, writing its rows (and its metrics) for the merge
+    metrics.reset()
+    os.makedirs(options.shard_dir, exist_ok=True)
+    shard_filename = get_shard_filename(cluster, shard)
+    tmp_filename = f"{shard_filename}.tmp"
+    ceph_cluster = connect_to_cluster(cluster, get_journal_filename(cluster, shard), create_scan_deadline())
+    with ceph_cluster, open(tmp_filename, "wb") as shard_file:
+        for mount_index, mount_path in enumerate(options.cluster_mount_paths[cluster]):
+            cluster_fs = ceph_cluster.mount(mount_path)
+            segment_rows = get_quota_row_segments(cluster_fs, cluster, mount_path, mount_index, shard)
+            write_segment_stream(shard_file, metrics.timed_iter("scan", segment_rows))
+    metrics.write(f"{shard_filename}.json")
+    # The merge only ever sees complete results
+    os.replace(tmp_filename, shard_filename)
+
+
+def write_shard_process(args, shard):
+    parse_args(args)
+    try:
+        for cluster in options.cluster_clients:
+            write_cluster_shard(cluster, shard)
+    except Exception as e:
+        print(f"Error scanning shard {shard[0]} of {shard[1]}\n\tError : {e}\n")
+        sys.exit(1)
+
+
+def read_cluster_shards(cluster, count):
+    shard_filenames = [get_shard_filename(cluster, (index, count)) for index in range(count)]
+    missing_filenames = [filename for filename in shard_filenames if not os.path.exists(filename)]
+    if missing_filenames:
+        raise Exception(f"Missing shard results for cluster {cluster}: {', '.join(missing_filenames)}")
+    for filename in shard_filenames:
+        with open(f"{filename}.json") as f:
+            metrics.merge(json.load(f))
+    return shard_filenames, merge_segment_streams([read_segment_stream_file(filename) for filename in shard_filenames])
 
 
 def create_report_files_for_cluster(cluster):
-    quotas_header = (
-        "Path",
-        "Byte Quota (Gibibytes)",
-        "Byte Usage (Gibibytes)",
-        "Percent Bytes Used (%)",
-        "File Count Quota",
-        "File Count Usage",
-        "Percent File Count Used (%)",
-        "Last Modified",
-        "Backing Pool",
+    if options.merge_shards:
+        # The rows were scanned by the shard workers, this only writes the reports
+        with connect_to_cluster(cluster) as ceph_cluster:
+            shard_filenames, quota_rows = read_cluster_shards(cluster, options.merge_shards)
+            tables = write_report_files(cluster, ceph_cluster, quota_rows)
+        for filename in shard_filenames:
+            os.remove(filename)
+            os.remove(f"{filename}.json")
+        return tables
+
+    mount_paths = options.cluster_mount_paths[cluster]
+    parallel_mounts = options.parallel and len(mount_paths) > 1
+    with tempfile.TemporaryDirectory() as part_dir:
+        part_filenames = [os.path.join(part_dir, f"{i}.part") for i in range(len(mount_paths))]
+        if parallel_mounts:
+            # Scan each mount in its own process with its own rados/cephfs handles, each writing its
+            # rows to a part file. The pool is started before this process connects to the cluster,
+            # so no RADOS state is inherited by the forked workers.
+            import multiprocessing
+
+            with multiprocessing.Pool(len(mount_paths), initializer=parse_args, initargs=(options.args,)) as pool:
+                mount_metrics = pool.starmap(
+                    write_mount_quota_rows, zip(itertools.repeat(cluster), mount_paths, part_filenames)
+                )
+            for mount_summary in mount_metrics:
+                metrics.merge(mount_summary)
+
+        journal_filename = get_journal_filename(cluster)
+        with connect_to_cluster(cluster, journal_filename, create_scan_deadline()) as ceph_cluster:
+            if parallel_mounts:
+                # Read the rows back in the order the mounts were given
+                quota_rows = itertools.chain.from_iterable(map(read_row_stream_file, part_filenames))
+            else:
+                mounts = [(mount_path, ceph_cluster.mount(mount_path)) for mount_path in mount_paths]
+                quota_rows = itertools.chain.from_iterable(
+                    get_quota_rows(mount_fs, cluster, mount_path) for mount_path, mount_fs in mounts
+                )
+                quota_rows = metrics.timed_iter("scan", quota_rows)
+            return write_report_files(cluster, ceph_cluster, quota_rows)
+
+
+def get_delta_description(delta_row_count, row_count, previous_filename, quota_filename):
+    return (
+        f"{delta_row_count} of {row_count} directories changed since {previous_filename}, "
+        f"see {quota_filename} for the full table."
     )
 
-    quota_rows = []
-    for mount_path in options.cluster_mount_paths[cluster]:
-        cluster_fs = CephFS_Wrapper(cluster, options.cluster_clients[cluster], options.filesystem_names[cluster], mount_path)
-        quota_rows.extend(get_quota_rows(cluster_fs, cluster, mount_path))
 
-    quota_filename = create_filename(cluster, options.report_file_pattern)
-    write_to_file(quota_filename, quotas_header, quota_rows)
+def write_report_files(cluster, ceph_cluster, quota_rows):
+    quota_fields = QuotaRow.FIELDS
+    if options.history_dir:
+        quota_fields += ("bytes_days_to_full", "files_days_to_full")
+    if options.scan_deadlines:
+        quota_fields += ("scan_status",)
 
     storage_header = (
         "Class",
@@ -314,43 +1445,517 @@ def create_report_files_for_cluster(cluster):
         "Raw Used (Tebibytes)",
         "% Used",
     )
-    pools_header = ("Pool", "Stored (Tebibytes)", "Available (Tebibytes)", "% Used", "Replication Factor")
-    backing_pools = set((row["backing_pool"] for row in quota_rows))
+    pools_header = (
+        "Pool",
+        "Stored (Tebibytes)",
+        "Available (Tebibytes)",
+        "% Used",
+        "Replication Factor",
+        "Data Protection",
+        "Device Class",
+    )
+
+    quota_filename = create_filename(cluster, options.report_file_pattern)
+
+    # The rows are written out as they are scanned, collecting their backing pools
+    # and the values for the report email along the way
+    collector = QuotaTableCollector(quota_fields, options.html_top_n, options.html_top_by)
+    quota_rows = collector.collect(quota_rows)
+    delta_collector = None
+    previous_filename = find_previous_report_file(cluster, options.report_file_pattern) if options.delta else None
+    if previous_filename:
+        # Joined with this run's rows by path as they stream past
+        delta_collector = QuotaDeltaCollector(
+            load_report_rows(previous_filename),
+            options.delta_min_bytes,
+            options.delta_min_files,
+            options.delta_thresholds,
+        )
+        quota_rows = delta_collector.collect(quota_rows)
+    if options.history_dir:
+        # NumPy is only needed when keeping a usage history, and the
+        # projections need every row of the cluster at once
+        from quota_history import add_projections
+
+        quota_rows = list(quota_rows)
+        with metrics.phase("history"):
+            add_projections(options.history_dir, cluster, quota_rows, options.history_window)
+    with metrics.phase("write_reports"):
+        write_to_file(
+            quota_filename, QuotaRow.header(quota_fields), quota_rows, quota_fields, options.export_formats
+        )
+
+    with metrics.phase("pool_data"):
+        storage_rows, pools_rows = get_storage_and_pool_data(ceph_cluster, collector.backing_pools)
 
-    storage_rows, pools_rows = get_storage_and_pool_data(cluster_fs, backing_pools)
     storage_filename = create_filename(cluster, options.storage_file_pattern)
     pools_filename = create_filename(cluster, options.pools_file_pattern)
-    write_to_file(storage_filename, storage_header, storage_rows)
-    write_to_file(pools_filename, pools_header, pools_rows)
+    with metrics.phase("write_reports"):
+        write_to_file(storage_filename, storage_header, storage_rows, export_formats=options.export_formats)
+        write_to_file(pools_filename, pools_header, pools_rows, export_formats=options.export_formats)
+
+    if delta_collector is None:
+        quota_table = ReportTable(
+            quota_filename, QuotaRow.header(quota_fields), collector.get_table_rows(), collector.get_description()
+        )
+    else:
+        delta_rows = delta_collector.get_delta_rows()
+        delta_filename = create_filename(cluster, options.delta_file_pattern)
+        with metrics.phase("write_reports"):
+            write_to_file(delta_filename, DELTA_HEADER, delta_rows)
+        row_count = delta_collector.row_count
+        description = get_delta_description(len(delta_rows), row_count, previous_filename, quota_filename)
+        quota_table = ReportTable(delta_filename, DELTA_HEADER, delta_rows, description)
 
-    return storage_filename, pools_filename, quota_filename
+    if options.journal_pattern:
+        remove_journal_files(cluster)
 
+    return [
+        ReportTable(storage_filename, storage_header, [tuple(row.values()) for row in storage_rows]),
+        ReportTable(pools_filename, pools_header, [tuple(row.values()) for row in pools_rows]),
+        quota_table,
+    ]
 
-def send_email(cluster, table_filenames):
+
+def get_attachment(filename):
+    # Returns the content, MIME type and filename of a report file's attachment
+    with open(filename, "rb") as f:
+        if not options.compress_attachments:
+            return f.read(), ("application", "octet-stream"), filename
+        compressed = io.BytesIO()
+        with gzip.GzipFile(filename=os.path.basename(filename), mode="wb", fileobj=compressed) as gz:
+            shutil.copyfileobj(f, gz)
+    return compressed.getvalue(), ("application", "gzip"), f"{filename}.gz"
+
+
+def create_message(cluster, html, attachments, receivers=None, subject=None):
     msg = EmailMessage()
-    formatter = BaseFormatter(table_files=table_filenames)
-    html = formatter.get_html()
     msg.set_content("This is a fallback for html report content.")
     msg.add_alternative(html, subtype="html")
     # Add attachments
-    for fname in table_filenames:
-        fpath = Path(fname)
-        with fpath.open("rb") as f:
-            msg.add_attachment(f.read(), "application", "octet-stream", filename=fname)
-    msg["Subject"] = f"Quota Usage Report for the {cluster} cluster on {datetime.date.today()}"
+    for content, (maintype, subtype), fname in attachments:
+        msg.add_attachment(content, maintype, subtype, filename=fname)
+    msg["Subject"] = subject or f"Quota Usage Report for the {cluster} cluster on {get_report_date()}"
     msg["From"] = options.sender
-    msg["To"] = options.receivers
+    msg["To"] = receivers or options.receivers
+    return msg
+
+
+def send_email(cluster, tables, delivery):
+    with metrics.phase("format_html"):
+        formatter = BaseFormatter(tables=tables)
+    attachment_filenames = [table.filename for table in tables]
+    quota_filename = create_filename(cluster, options.report_file_pattern)
+    if quota_filename not in attachment_filenames and os.path.exists(quota_filename):
+        # A delta report's email has the table of changes instead of the full report, which is still attached
+        attachment_filenames.append(quota_filename)
+    with metrics.phase("attachments"):
+        attachments = [get_attachment(filename) for filename in attachment_filenames]
+    notes = list()
+    # The summary can only cover the run up to here, the full summary (with the email itself) is in the metrics file
+    footer = metrics.get_summary_lines() if options.email_run_metrics else ()
+    with tempfile.TemporaryFile() as message_file:
+        while True:
+            with metrics.phase("format_html"):
+                html = formatter.get_html(notes, footer)
+            with metrics.phase("create_message"):
+                msg = create_message(cluster, html, attachments)
+                message_file.seek(0)
+                message_file.truncate()
+                BytesGenerator(message_file, policy=policy.SMTP).flatten(msg)
+            if not options.max_message_size or message_file.tell() <= options.max_message_size or not attachments:
+                break
+            # Leave out the largest attachment until the message is small enough
+            largest_attachment = max(attachments, key=lambda attachment: len(attachment[0]))
+            attachments.remove(largest_attachment)
+            notes.append(
+                f"{largest_attachment[2]} was left out of this email to keep it under {options.max_message_size} bytes."
+            )
+
+        with metrics.phase("smtp"):
+            delivery.send(options.sender, options.receivers, message_file)
+
+
+def iter_group_messages(cluster, group_tables):
+    # Yields the (sender, receivers, message_file) of each group's email, one message at a time
+    subject = f"Quota Usage Report for your directories on the {cluster} cluster on {get_report_date()}"
+    for receiver, table in group_tables:
+        with tempfile.TemporaryFile() as message_file:
+            with metrics.phase("format_html"):
+                html = BaseFormatter(tables=[table]).get_html()
+            with metrics.phase("create_message"):
+                msg = create_message(cluster, html, (), [receiver], subject)
+                BytesGenerator(message_file, policy=policy.SMTP).flatten(msg)
+            yield options.sender, [receiver], message_file
 
-    s = smtplib.SMTP("postfix-mail", 587)
-    s.send_message(msg)
-    s.quit()
+
+def send_group_emails(cluster, delivery):
+    # Each group gets its own directories' rows of the quota report file, so however many groups
+    # there are, the cluster is only scanned once
+    path_recipients = options.group_recipients.get(cluster)
+    if not path_recipients:
+        return
+    quota_table = load_report_table(create_filename(cluster, options.report_file_pattern))
+    group_tables = get_group_tables(quota_table, path_recipients)
+    with metrics.phase("group_emails"):
+        sent_count = delivery.send_batch(iter_group_messages(cluster, group_tables))
+    metrics.count("group_emails", sent_count)
+
+
+def send_report_emails(cluster, tables, delivery):
+    send_email(cluster, tables, delivery)
+    if options.group_recipients:
+        send_group_emails(cluster, delivery)
+
+
+def create_mail_delivery():
+    return MailDelivery(options.smtp_host, options.smtp_port, options.mail_queue_dir, options.smtp_retries)
+
+
+def report_cluster(cluster, delivery):
+    metrics.reset()
+    try:
+        cluster_tables = create_report_files_for_cluster(cluster)
+        send_report_emails(cluster, cluster_tables, delivery)
+    finally:
+        # Slow or failed runs are the ones worth having metrics for
+        if options.run_metrics_pattern:
+            metrics.write(create_filename(cluster, options.run_metrics_pattern, "json"))
+
+
+def load_report_tables(cluster):
+    # The tables of a cluster's report email, read back from the report files that a scan wrote
+    storage_filename = create_filename(cluster, options.storage_file_pattern)
+    pools_filename = create_filename(cluster, options.pools_file_pattern)
+    quota_filename = create_filename(cluster, options.report_file_pattern)
+    delta_filename = create_filename(cluster, options.delta_file_pattern)
+    report_filenames = [storage_filename, pools_filename, quota_filename] + ([delta_filename] if options.delta else [])
+    missing_filenames = [filename for filename in report_filenames if not os.path.exists(filename)]
+    if missing_filenames:
+        raise Exception(f"Missing report files for cluster {cluster}: {', '.join(missing_filenames)}")
+
+    tables = [load_report_table(storage_filename), load_report_table(pools_filename)]
+    if options.delta:
+        delta_table = load_report_table(delta_filename)
+        row_count = len(load_report_table(quota_filename).rows)
+        previous_filename = find_previous_report_file(cluster, options.report_file_pattern)
+        delta_table.description = get_delta_description(
+            len(delta_table.rows), row_count, previous_filename, quota_filename
+        )
+        tables.append(delta_table)
+    else:
+        # The same table as the scan's email, e.g. only the top rows with "--html-top-n"
+        quota_table = load_report_table(quota_filename)
+        field_by_column = {column: field for field, column in QuotaRow.COLUMNS.items()}
+        quota_fields = tuple(field_by_column[column] for column in quota_table.header)
+        collector = QuotaTableCollector(quota_fields, options.html_top_n, options.html_top_by)
+        quota_rows = (QuotaRow(**dict(zip(quota_fields, row))) for row in quota_table.rows)
+        for _ in collector.collect(quota_rows):
+            pass
+        tables.append(
+            ReportTable(quota_filename, quota_table.header, collector.get_table_rows(), collector.get_description())
+        )
+    return tables
+
+
+def render_cluster(cluster, delivery):
+    tables = load_report_tables(cluster)
+    if options.html_only:
+        html_filename = create_filename(cluster, options.report_file_pattern, "html")
+        with open(html_filename, "w") as f:
+            f.write(BaseFormatter(tables=tables).get_html())
+        print(f"Wrote {html_filename}")
+        return
+    send_report_emails(cluster, tables, delivery)
+
+
+def render_reports():
+    with create_mail_delivery() as delivery:
+        for cluster in options.cluster_clients:
+            render_cluster(cluster, delivery)
+
+
+def report_cluster_process(args, cluster):
+    parse_args(args)
+    try:
+        with create_mail_delivery() as delivery:
+            report_cluster(cluster, delivery)
+    except Exception as e:
+        print(f"Error reporting on cluster {cluster}\n\tError : {e}\n")
+        sys.exit(1)
+
+
+def create_async_executor():
+    # Threads for every cluster's scan workers, plus two per cluster for writing its reports
+    # and everything else (connecting, mounting and sending its email)
+    cluster_count = len(options.cluster_clients)
+    return ThreadPoolExecutor(max_workers=(options.scan_workers + 2) * cluster_count)
+
+
+def run_async(coroutine):
+    # Runs coroutine on this thread's event loop, cancelling it (and waiting for it to finish
+    # cancelling) if it's interrupted
+    import asyncio
+
+    loop = asyncio.get_event_loop()
+    task = asyncio.ensure_future(coroutine)
+    try:
+        return loop.run_until_complete(task)
+    except BaseException:
+        task.cancel()
+        loop.run_until_complete(asyncio.wait([task]))
+        raise
+
+
+async def iter_cluster_quota_rows_async(cluster, mounts):
+    for mount_path, async_fs in mounts:
+        async for row in get_quota_rows_async(async_fs, cluster, mount_path):
+            yield row
+
+
+async def report_cluster_async(cluster, executor, delivery, send_lock):
+    import asyncio
+
+    ceph_cluster = await asyncio.get_event_loop().run_in_executor(
+        executor, connect_to_cluster, cluster, get_journal_filename(cluster), create_scan_deadline()
+    )
+    async_cluster = AsyncCephCluster(ceph_cluster, executor, options.scan_workers)
+    stopped = threading.Event()
+    try:
+        mounts = list()
+        for mount_path in options.cluster_mount_paths[cluster]:
+            mounts.append((mount_path, await async_cluster.mount(mount_path)))
+        # The report files are written from a thread, which takes the rows from the event loop as they are scanned
+        quota_rows = iter_cluster_quota_rows_async(cluster, mounts)
+        quota_rows = iterate_in_thread(quota_rows, asyncio.get_event_loop(), stopped)
+        quota_rows = metrics.timed_iter("scan", quota_rows)
+        tables = await async_cluster.run(write_report_files, cluster, ceph_cluster, quota_rows)
+    finally:
+        # Nothing may still be using the cluster when it's shut down
+        stopped.set()
+        await asyncio.get_event_loop().run_in_executor(executor, async_cluster.wait_pending)
+        await asyncio.get_event_loop().run_in_executor(executor, ceph_cluster.shutdown)
+
+    # Emails go out as soon as each cluster's report is written, one at a time over the shared connection
+    async with send_lock:
+        await asyncio.get_event_loop().run_in_executor(executor, send_report_emails, cluster, tables, delivery)
+
+
+async def report_clusters_async(executor, delivery):
+    import asyncio
+
+    clusters = list(options.cluster_clients)
+    send_lock = asyncio.Lock()
+    tasks = [
+        asyncio.ensure_future(report_cluster_async(cluster, executor, delivery, send_lock)) for cluster in clusters
+    ]
+    try:
+        results = await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        # No cluster's task outlives the run, even when the run is cancelled
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.wait(tasks)
+
+    failed_clusters = list()
+    for cluster, result in zip(clusters, results):
+        if isinstance(result, Exception):
+            print(f"Error reporting on cluster {cluster}\n\tError : {result}\n")
+            failed_clusters.append(cluster)
+    if failed_clusters:
+        raise Exception(f"Failed to report on cluster(s): {', '.join(failed_clusters)}")
+
+
+def report_clusters_with_asyncio():
+    # Every cluster is scanned from one event loop, sharing one thread pool
+    metrics.reset()
+    try:
+        with create_mail_delivery() as delivery, create_async_executor() as executor:
+            run_async(report_clusters_async(executor, delivery))
+    finally:
+        if options.run_metrics_pattern:
+            metrics.write(create_filename("_".join(options.cluster_clients), options.run_metrics_pattern, "json"))
+
+
+def refresh_cluster(cache, cluster, ceph_cluster, mounts):
+    # Returns whether the refresh succeeded
+    cluster_start = time.time()
+    try:
+        quota_rows = list()
+        for mount_path, cluster_fs in mounts:
+            cluster_fs.clear_cache()
+            quota_rows.extend(get_quota_rows(cluster_fs, cluster, mount_path))
+        if not ceph_cluster.snapshot is None:
+            ceph_cluster.snapshot.flush()
+        cache.update(cluster, quota_rows, time.time() - cluster_start)
+        return True
+    except Exception as e:
+        print(f"Error refreshing quota data for cluster {cluster}\n\tError : {e}\n")
+        cache.update_failed(cluster, time.time() - cluster_start)
+        return False
+
+
+async def refresh_cluster_async(cache, cluster, async_cluster, mounts):
+    cluster_start = time.time()
+    try:
+        quota_rows = list()
+        for mount_path, async_fs in mounts:
+            async_fs.cluster_fs.clear_cache()
+            async for row in get_quota_rows_async(async_fs, cluster, mount_path):
+                quota_rows.append(row)
+        if not async_cluster.ceph_cluster.snapshot is None:
+            await async_cluster.run(async_cluster.ceph_cluster.snapshot.flush)
+        cache.update(cluster, quota_rows, time.time() - cluster_start)
+        return True
+    except Exception as e:
+        print(f"Error refreshing quota data for cluster {cluster}\n\tError : {e}\n")
+        cache.update_failed(cluster, time.time() - cluster_start)
+        return False
+
+
+async def refresh_clusters_async(cache, sessions, executor):
+    # Returns whether each cluster's refresh succeeded
+    import asyncio
+
+    refreshes = list()
+    for cluster, (ceph_cluster, mounts) in sessions.items():
+        async_cluster = AsyncCephCluster(ceph_cluster, executor, options.scan_workers)
+        async_mounts = [
+            (mount_path, AsyncCephFS_Wrapper(async_cluster, cluster_fs)) for mount_path, cluster_fs in mounts
+        ]
+        refreshes.append(refresh_cluster_async(cache, cluster, async_cluster, async_mounts))
+    return await asyncio.gather(*refreshes)
+
+
+def connect_cluster_session(cluster):
+    # Connects to the cluster and mounts every one of its mount paths, returning (ceph_cluster, mounts)
+    ceph_cluster = connect_to_cluster(cluster)
+    try:
+        mounts = [(mount_path, ceph_cluster.mount(mount_path)) for mount_path in options.cluster_mount_paths[cluster]]
+    except Exception:
+        ceph_cluster.shutdown()
+        raise
+    return ceph_cluster, mounts
+
+
+def shutdown_cluster_session(cluster, session):
+    try:
+        session[0].shutdown()
+    except Exception as e:
+        print(f"Error disconnecting from cluster {cluster}\n\tError : {e}\n")
+
+
+def shutdown_cluster_sessions(sessions):
+    for cluster, session in sessions.items():
+        if not session is None:
+            shutdown_cluster_session(cluster, session)
+
+
+def serve_metrics():
+    # Keep one session open to every cluster, re-reading the quota rows every refresh_interval seconds
+    # and serving the rows from the last refresh over HTTP in between
+    from metrics_exporter import QuotaMetricsCache, start_metrics_server
+
+    cache = QuotaMetricsCache()
+    server = start_metrics_server(options.serve_address, options.serve_port, cache)
+    with ExitStack() as stack:
+        stack.callback(server.server_close)
+        stack.callback(server.shutdown)
+        sessions = dict()
+        stack.callback(shutdown_cluster_sessions, sessions)
+        for cluster in options.cluster_clients:
+            sessions[cluster] = connect_cluster_session(cluster)
+
+        executor = None
+        if options.engine == "asyncio":
+            # The clusters are refreshed at the same time from one event loop
+            executor = stack.enter_context(create_async_executor())
+
+        while True:
+            refresh_start = time.time()
+            connected_sessions = dict()
+            for cluster in options.cluster_clients:
+                if sessions[cluster] is None:
+                    try:
+                        sessions[cluster] = connect_cluster_session(cluster)
+                    except Exception as e:
+                        print(f"Error reconnecting to cluster {cluster}\n\tError : {e}\n")
+                        cache.update_failed(cluster, time.time() - refresh_start)
+                        continue
+                connected_sessions[cluster] = sessions[cluster]
+
+            if executor is None:
+                refreshed = [
+                    refresh_cluster(cache, cluster, ceph_cluster, mounts)
+                    for cluster, (ceph_cluster, mounts) in connected_sessions.items()
+                ]
+            else:
+                refreshed = run_async(refresh_clusters_async(cache, connected_sessions, executor))
+            for cluster, success in zip(connected_sessions, refreshed):
+                if not success:
+                    # An evicted or blocklisted mount fails every refresh after it, so the cluster's
+                    # session is replaced with a new one on the next refresh
+                    shutdown_cluster_session(cluster, sessions[cluster])
+                    sessions[cluster] = None
+            time.sleep(max(0, options.refresh_interval - (time.time() - refresh_start)))
+
+
+def run_processes(processes):
+    # Runs the processes to completion, returning the names of the ones that failed
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    return [process.name for process in processes if process.exitcode != 0]
 
 
 def main(args):
     parse_args(args)
-    for cluster in options.cluster_clients:
-        cluster_filenames = list(create_report_files_for_cluster(cluster))
-        send_email(cluster, cluster_filenames)
+    if options.render:
+        render_reports()
+        return
+    if options.serve_port:
+        serve_metrics()
+        return
+    if not options.shard is None:
+        # A shard worker only writes its part of the rows, the merge writes the reports and sends the emails
+        for cluster in options.cluster_clients:
+            write_cluster_shard(cluster, options.shard)
+        return
+    # Try again to send any emails that couldn't be sent on an earlier run
+    with create_mail_delivery() as delivery:
+        delivery.flush_queue()
+    if options.shards:
+        # Scan every shard in its own local process before merging them
+        import multiprocessing
+
+        shard_processes = [
+            multiprocessing.Process(target=write_shard_process, args=(args, (index, options.shards)), name=str(index))
+            for index in range(options.shards)
+        ]
+        failed_shards = run_processes(shard_processes)
+        if failed_shards:
+            raise Exception(f"Failed to scan shard(s): {', '.join(failed_shards)}")
+
+    if options.engine == "asyncio" and not options.merge_shards:
+        report_clusters_with_asyncio()
+    elif options.parallel:
+        # The clusters are independent, so each one is scanned (and has its email sent) by its own process
+        import multiprocessing
+
+        cluster_processes = [
+            multiprocessing.Process(target=report_cluster_process, args=(args, cluster), name=cluster)
+            for cluster in options.cluster_clients
+        ]
+        failed_clusters = run_processes(cluster_processes)
+        if failed_clusters:
+            raise Exception(f"Failed to report on cluster(s): {', '.join(failed_clusters)}")
+    else:
+        # Every cluster's email goes out over the same SMTP connection
+        with create_mail_delivery() as delivery:
+            for cluster in options.cluster_clients:
+                report_cluster(cluster, delivery)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+import time
+import threading
+
+#
+# Adaptive limit on how many calls to a cluster's MDS are in flight at a time, so a scan goes as fast as
+# the MDS can answer without pushing up the metadata latency of everything else using the cluster.
+#
+# The limit is controlled AIMD-style (like TCP congestion control): it grows by one after a limit's worth
+# of calls in a row came back within the latency target, and is halved when a call is slower than the
+# target or fails. It never goes above the hard cap set for the cluster.
+#
+# A call that is given up on while it's still stuck on the MDS (see TimedCallPool) gives its slot back
+# straight away, so it doesn't hold the limit down, but it still counts toward the hard cap until it
+# returns. Any call it goes on to make fails rather than waiting for a slot.
+#
+
+
+class AdaptiveConcurrencyLimit:
+    DECREASE_FACTOR = 0.5
+
+    def __init__(self, latency_target, max_limit, min_limit=1):
+        self.latency_target = latency_target
+        self.max_limit = max(min_limit, max_limit)
+        self.min_limit = min_limit
+        # Starts low and grows to what the MDS can take, rather than starting with a burst
+        self.limit = float(min_limit)
+        self.in_flight = 0
+        self.fast_calls = 0
+        self.decrease_count = 0
+        self.last_decrease_time = time.monotonic()
+        self.condition = threading.Condition()
+        # Start times of the calls made for an owner (e.g. the future of a timed call), by owner
+        self.owned_calls = dict()
+        self.abandoned_owners = set()
+        # The owners whose abandoned calls are still stuck on the MDS
+        self.stuck_owners = set()
+
+    def acquire(self, timeout=None, owner=None):
+        # Waits for a free slot for at most timeout seconds, returning the time the call started at for
+        # release, or None if no slot came free in time or owner was abandoned
+        with self.condition:
+            has_slot = lambda: owner in self.abandoned_owners or (
+                self.in_flight < int(self.limit) and self.in_flight + len(self.stuck_owners) < self.max_limit
+            )
+            if not self.condition.wait_for(has_slot, timeout) or owner in self.abandoned_owners:
+                return None
+            start_time = time.monotonic()
+            self.in_flight += 1
+            if not owner is None:
+                self.owned_calls[owner] = start_time
+            return start_time
+
+    def release(self, start_time, failed=False, owner=None):
+        with self.condition:
+            if not owner is None and self.owned_calls.pop(owner, None) is None:
+                # The slot was already given back by abandon, and the call is off the hard cap now too
+                if owner in self.stuck_owners:
+                    self.stuck_owners.discard(owner)
+                    self.condition.notify()
+                return
+            self.free_slot(start_time, failed)
+
+    def abandon(self, owner):
+        # Gives back the slot of owner's call, which is still stuck on the MDS, counting it as slow.
+        # owner is a future, and once it's done, nothing is left running for it.
+        with self.condition:
+            self.abandoned_owners.add(owner)
+            start_time = self.owned_calls.pop(owner, None)
+            if not start_time is None:
+                self.stuck_owners.add(owner)
+                self.free_slot(start_time, True)
+            # Calls of owner that are waiting for a slot don't have to anymore
+            self.condition.notify_all()
+        owner.add_done_callback(self.forget)
+
+    def forget(self, owner):
+        with self.condition:
+            self.abandoned_owners.discard(owner)
+            if owner in self.stuck_owners:
+                self.stuck_owners.discard(owner)
+                self.condition.notify()
+
+    def free_slot(self, start_time, failed):
+        # Called with the condition held
+        self.in_flight -= 1
+        end_time = time.monotonic()
+        if failed or end_time - start_time > self.latency_target:
+            # Calls that were already in flight when the limit was last cut are answered slowly
+            # for the same reason, so they don't cut it again
+            if start_time >= self.last_decrease_time:
+                self.limit = max(self.min_limit, self.limit * self.DECREASE_FACTOR)
+                self.last_decrease_time = end_time
+                self.decrease_count += 1
+            self.fast_calls = 0
+        else:
+            self.fast_calls += 1
+            if self.fast_calls >= int(self.limit):
+                self.limit = min(self.max_limit, self.limit + 1)
+                self.fast_calls = 0
+        self.condition.notify(max(int(self.limit) - self.in_flight, 0))
@@ -29,6 +29,12 @@ DEFAULT_COL_FORMATS = {
     "Percent File Count Used (%)": lambda x: f'<td class="numeric">{float(x):.2f}</td>',
     "Last Modified": lambda x: f'<td class="text">{str(x)}</td>',
     "Backing Pool": lambda x: f'<td class="text">{str(x)}</td>',
+    "Days Until Byte Quota Is Full": lambda x: f'<td class="numeric">{float(x):.1f}</td>',
+    "Days Until File Count Quota Is Full": lambda x: f'<td class="numeric">{float(x):.1f}</td>',
+    "Scan Status": lambda x: f'<td class="text">{str(x)}</td>',
+    "Change": lambda x: f'<td class="text">{str(x)}</td>',
+    "Byte Usage Change (Gibibytes)": lambda x: f'<td class="numeric">{str(x)}</td>',
+    "File Count Usage Change": lambda x: f'<td class="numeric">{str(x)}</td>',
     "Class": lambda x: f'<td class="text">{str(x)}</td>',
     "Total Size (Tebibytes)": lambda x: f'<td class="numeric">{float(x):.2f}</td>',
     "Available (Tebibytes)": lambda x: f'<td class="numeric">{float(x):.2f}</td>',
@@ -37,6 +43,8 @@ DEFAULT_COL_FORMATS = {
     "% Used": lambda x: f'<td class="numeric">{float(x):.2f}</td>',
     "Pool": lambda x: f'<td class="text">{str(x)}</td>',
     "Stored (Tebibytes)": lambda x: f'<td class="numeric">{float(x):.2f}</td>',
+    "Data Protection": lambda x: f'<td class="text">{str(x)}</td>',
+    "Device Class": lambda x: f'<td class="text">{str(x)}</td>',
 }
 
 DEFAULT_STYLES = {
@@ -67,28 +75,94 @@ DEFAULT_STYLES = {
     "td.text": ["text-align: left"],
     "td.numeric": ["text-align: right"],
     "td.other": ["text-align: right"],
+    "p.footer": ["font-size: 9pt", "color: #666"],
 }
 
 
+class ReportTable:
+    # A table of typed values (None where there is no value), the name of the file it was written
+    # to and an optional description shown under the table's title
+    def __init__(self, filename, header, rows, description=None):
+        self.filename = filename
+        self.header = tuple(header)
+        self.rows = rows
+        self.description = description
+
+
+def parse_value(value):
+    # Type a value read back from a report file
+    if value == "-":
+        return None
+    for value_type in (int, float):
+        try:
+            return value_type(value)
+        except ValueError:
+            pass
+    return value
+
+
+def iter_report_file(filename):
+    # Yields the header of a report file, then the typed values of each of its rows. Report files
+    # are written with "|" as their quote character (see CSVReportWriter), e.g. for "ssd,nvme".
+    with open(filename, newline="") as f:
+        reader = csv.reader(f, delimiter=",", quotechar="|")
+        yield next(reader)
+        for row in reader:
+            yield [parse_value(value) for value in row]
+
+
+def load_report_table(filename):
+    # Read a report file back into a table of typed values
+    rows = iter_report_file(filename)
+    header = next(rows)
+    return ReportTable(filename, header, list(rows))
+
+
 class BaseFormatter:
-    def __init__(self, table_files, *args, **kwargs):
+    # The CSS and the column formatters of each header, with the default styles and formats they're
+    # the same for every table and email, so they're only built once (e.g. for many group emails)
+    default_css = None
+    default_column_formatters = dict()
+
+    def __init__(self, table_files=(), tables=(), *args, **kwargs):
         self.html_tables = []
         self.table_files = table_files
-        for table_file in table_files:
-            self.html_tables.append(self.get_table_html(table_file, **kwargs))
+        self.tables = list(tables) + [self.load_table(table_file) for table_file in table_files]
+        for table in self.tables:
+            self.html_tables.append(self.get_table_html(table, **kwargs))
 
     def load_table(self, filename):
-        with open(filename) as f:
-            reader = csv.reader(f)
-            header = [""] + next(reader)
-            rows = [[""] + row for row in reader]
-        data = {
-            "header": header,
-            "rows": rows,
-        }
-        return data
+        return load_report_table(filename)
+
+    def get_column_formatter(self, col, fmts, default_text_fmt, default_numeric_fmt):
+        # Resolve how a column is formatted once, rather than trying formatters on every value
+        fmt = fmts.get(col)
+        numeric_fmt = fmt if fmt is not None else default_numeric_fmt
+        text_fmt = default_text_fmt
+        if fmt is not None:
+            try:
+                fmt("")
+                text_fmt = fmt
+            except ValueError:
+                pass
+
+        def format_value(value):
+            if value is None:
+                return default_text_fmt("-")
+            if isinstance(value, str):
+                return text_fmt(value)
+            # Any column with a numeric value < 0 is undefined
+            if value < 0:
+                return default_text_fmt("")
+            return numeric_fmt(value)
+
+        return format_value
 
     def format_rows(self, header, rows, custom_fmts={}, default_text_fmt=None, default_numeric_fmt=None):
+        # Only the column formatters of the default formats are cached
+        cache_key = None
+        if not custom_fmts and default_text_fmt is None and default_numeric_fmt is None:
+            cache_key = (type(self), tuple(header))
         fmts = DEFAULT_COL_FORMATS.copy()
         fmts.update(custom_fmts)
         if default_text_fmt is None:
@@ -96,47 +170,26 @@ class BaseFormatter:
         if default_numeric_fmt is None:
             default_numeric_fmt = DEFAULT_NUMERIC_FORMAT
 
-        rows = rows.copy()
+        col_fmts = self.default_column_formatters.get(cache_key)
+        if col_fmts is None:
+            col_fmts = [self.get_column_formatter(col, fmts, default_text_fmt, default_numeric_fmt) for col in header]
+            if not cache_key is None:
+                self.default_column_formatters[cache_key] = col_fmts
+
+        formatted_rows = []
         for i, row in enumerate(rows):
-            for j, value in enumerate(row):
-                col = header[j]
-
-                # First column (blank header) contains row number
-                if col == "" and value == "":
-                    rows[i][j] = default_numeric_fmt(float(i + 1))
-                    continue
-
-                # Any column with a numeric value < 0 is undefined
-                try:
-                    if float(value) < 0:
-                        value = ""
-                except ValueError:
-                    pass
-
-                # Try to format columns as numeric (or as defined
-                # in fmts), otherwise it's a string
-                if col in fmts:
-                    try:
-                        rows[i][j] = fmts[col](value)
-                    except ValueError:
-                        try:
-                            rows[i][j] = fmts[col](float(value))
-                        except ValueError:
-                            rows[i][j] = default_text_fmt(value)
-                else:
-                    try:
-                        rows[i][j] = default_numeric_fmt(float(value))
-                    except ValueError:
-                        rows[i][j] = default_text_fmt(value)
-
-        return rows
+            # First column contains row number
+            formatted_row = [default_numeric_fmt(i + 1)]
+            formatted_row.extend(col_fmt(value) for col_fmt, value in zip(col_fmts, row))
+            formatted_rows.append(formatted_row)
+
+        return formatted_rows
 
     def get_table_title(self, table_file):
         return str(table_file).strip(".csv").replace("_", " ")
 
-    def get_table_html(self, table_file, **kwargs):
-        table_data = self.load_table(table_file)
-        rows = self.format_rows(table_data["header"], table_data["rows"])
+    def get_table_html(self, table, **kwargs):
+        rows = self.format_rows(table.header, table.rows)
 
         rows_html = []
         for i, row in enumerate(rows):
@@ -144,16 +197,20 @@ class BaseFormatter:
             rows_html.append(f'<tr class="{tr_class}">{"".join(row)}</tr>')
 
         newline = "\n  "
+        description = f"<p>{table.description}</p>" if table.description else ""
         html = f"""
-<h1>{self.get_table_title(table_file)}</h1>
+<h1>{self.get_table_title(table.filename)}</h1>
+{description}
 <table>
-  <tr><th>{'</th><th>'.join(table_data['header'])}</th></tr>
+  <tr><th>{'</th><th>'.join(("",) + table.header)}</th></tr>
   {newline.join(rows_html)}
 </table>
 """
         return html
 
     def get_css(self, custom_styles={}):
+        if not custom_styles and not BaseFormatter.default_css is None:
+            return BaseFormatter.default_css
         styles = DEFAULT_STYLES.copy()
         styles.update(custom_styles)
 
@@ -163,17 +220,21 @@ class BaseFormatter:
             attrs = [f"{attr};" for attr in attrs]
             style += f"{tag} {{\n  {newline_tab.join(attrs)}\n}}\n"
 
+        if not custom_styles:
+            BaseFormatter.default_css = style
         return style
 
-    def get_html(self):
+    def get_html(self, notes=(), footer=()):
         newline = "\n"
+        notes_html = [f"<p>{note}</p>" for note in notes]
+        footer_html = [f'<p class="footer">{line}</p>' for line in footer]
         html = f"""
 <html>
 <head>
 <style>{self.get_css()}</style>
 </head>
 <body>
-{newline.join(self.html_tables)}
+{newline.join(notes_html + self.html_tables + footer_html)}
 </body>
 </html>
 """
@@ -0,0 +1,60 @@
+import os
+import json
+
+from email_formatter import ReportTable
+
+#
+# Splits one cluster's quota report into a table per recipient, for the groups that should each get an
+# email about their own directories. Recipients are mapped to directories by path prefix: a recipient
+# of a directory also gets the rows of every directory underneath it.
+#
+
+
+def load_group_recipients(filename):
+    # Reads a JSON object of "<cluster>:<path>" to a recipient (or a list of them) into a cluster to
+    # path to recipients mapping
+    with open(filename) as f:
+        group_recipients = json.load(f)
+    cluster_recipients = dict()
+    for cluster_path, recipients in group_recipients.items():
+        cluster, path = cluster_path.split(":", 1)
+        if isinstance(recipients, str):
+            recipients = [recipients]
+        path_recipients = cluster_recipients.setdefault(cluster, dict())
+        path_recipients.setdefault(os.path.normpath(path), list()).extend(recipients)
+    return cluster_recipients
+
+
+class PathPrefixIndex:
+    # Finds the recipients of a path and of all of its parent directories, with one dict lookup per
+    # level of the path rather than a comparison with every prefix
+    def __init__(self, path_recipients):
+        self.path_recipients = path_recipients
+
+    def get_recipients(self, path):
+        recipients = set()
+        path = os.path.normpath(path)
+        while True:
+            recipients.update(self.path_recipients.get(path, ()))
+            parent = os.path.dirname(path)
+            if parent == path:
+                return recipients
+            path = parent
+
+
+def get_group_tables(table, path_recipients):
+    # Returns (recipient, table) pairs, each with the rows of the quota report table that are in or
+    # under the recipient's directories, in report order
+    index = PathPrefixIndex(path_recipients)
+    path_column = table.header.index("Path")
+    recipient_rows = dict()
+    for row in table.rows:
+        for recipient in index.get_recipients(str(row[path_column])):
+            recipient_rows.setdefault(recipient, list()).append(row)
+
+    group_tables = list()
+    for recipient, rows in sorted(recipient_rows.items()):
+        group_paths = sorted(path for path, recipients in path_recipients.items() if recipient in recipients)
+        description = f"The directories in and under {', '.join(group_paths)}."
+        group_tables.append((recipient, ReportTable(table.filename, table.header, rows, description)))
+    return group_tables
@@ -0,0 +1,122 @@
+import time
+import datetime
+import threading
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+#
+# Serves the latest quota rows of each cluster as OpenMetrics text. The text is rendered once per refresh
+# and scrapes only ever read the rendered copy, so a scrape never waits on (or causes) a CephFS request.
+#
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+# Metric family name, QuotaRow field, unit and help text of each per-directory metric
+DIRECTORY_METRICS = (
+    ("cephfs_quota_used_gibibytes", "bytes_used", "gibibytes", "Size of all files in and underneath the directory."),
+    ("cephfs_quota_limit_gibibytes", "bytes_quota", "gibibytes", "Byte quota of the directory."),
+    ("cephfs_quota_used_files", "files_used", "files", "Count of all files in and underneath the directory."),
+    ("cephfs_quota_limit_files", "files_quota", "files", "File count quota of the directory."),
+    (
+        "cephfs_quota_last_modified_timestamp_seconds",
+        "last_modified_date",
+        "seconds",
+        "Day a file underneath the directory was last changed.",
+    ),
+)
+
+
+def escape_label_value(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(labels):
+    return ",".join(f'{name}="{escape_label_value(value)}"' for name, value in labels)
+
+
+def date_to_timestamp(date):
+    return datetime.datetime.strptime(date, "%Y-%m-%d").replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class QuotaMetricsCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cluster_rows = dict()
+        self.cluster_refreshes = dict()
+        self.payload = self.render()
+
+    def update(self, cluster, rows, duration):
+        with self.lock:
+            self.cluster_rows[cluster] = rows
+            self.cluster_refreshes[cluster] = (time.time(), duration, 1)
+            self.payload = self.render()
+
+    def update_failed(self, cluster, duration):
+        # Keep serving the last rows that were read, but flag that they're from an earlier refresh
+        with self.lock:
+            last_refresh = self.cluster_refreshes.get(cluster, (0, 0, 0))
+            self.cluster_refreshes[cluster] = (last_refresh[0], duration, 0)
+            self.payload = self.render()
+
+    def get(self):
+        return self.payload
+
+    def render(self):
+        lines = list()
+        for name, field, unit, help_text in DIRECTORY_METRICS:
+            lines.extend((f"# TYPE {name} gauge", f"# UNIT {name} {unit}", f"# HELP {name} {help_text}"))
+            for cluster, rows in self.cluster_rows.items():
+                for row in rows:
+                    value = getattr(row, field)
+                    if value is None:
+                        continue
+                    if field == "last_modified_date":
+                        value = date_to_timestamp(value)
+                    labels = format_labels((("cluster", cluster), ("path", row.path), ("pool", row.backing_pool)))
+                    lines.append(f"{name}{{{labels}}} {value}")
+
+        refresh_metrics = (
+            ("cephfs_quota_refresh_timestamp_seconds", "seconds", "Time the quota data was last read successfully."),
+            ("cephfs_quota_refresh_duration_seconds", "seconds", "Time the last refresh of the quota data took."),
+            ("cephfs_quota_refresh_success", None, "Whether the last refresh of the quota data succeeded."),
+        )
+        for i, (name, unit, help_text) in enumerate(refresh_metrics):
+            lines.append(f"# TYPE {name} gauge")
+            if unit:
+                lines.append(f"# UNIT {name} {unit}")
+            lines.append(f"# HELP {name} {help_text}")
+            for cluster, refresh in self.cluster_refreshes.items():
+                lines.append(f"{name}{{{format_labels((('cluster', cluster),))}}} {refresh[i]}")
+
+        lines.append("# EOF")
+        return ("\n".join(lines) + "\n").encode()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    cache = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        payload = self.cache.get()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_metrics_server(address, port, cache):
+    handler = type("QuotaMetricsRequestHandler", (MetricsRequestHandler,), {"cache": cache})
+    server = MetricsServer((address, port), handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
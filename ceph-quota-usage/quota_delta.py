@@ -0,0 +1,104 @@
+from email_formatter import iter_report_file
+from quota_row import QuotaRow
+
+#
+# Compares a run's quota rows with the rows of the previous run's report file, keeping only the
+# directories that appeared, disappeared, had their quota changed, changed their usage by more than
+# a minimum or crossed a percent used threshold.
+#
+
+DELTA_HEADER = (
+    QuotaRow.COLUMNS["path"],
+    "Change",
+    QuotaRow.COLUMNS["bytes_used"],
+    "Byte Usage Change (Gibibytes)",
+    QuotaRow.COLUMNS["bytes_percent"],
+    QuotaRow.COLUMNS["files_used"],
+    "File Count Usage Change",
+    QuotaRow.COLUMNS["files_percent"],
+)
+
+
+def load_report_rows(filename):
+    # Returns a path to QuotaRow index of the rows of a quota report file
+    field_by_column = {column: field for field, column in QuotaRow.COLUMNS.items()}
+    rows = dict()
+    report_rows = iter_report_file(filename)
+    fields = [field_by_column.get(column) for column in next(report_rows)]
+    for values in report_rows:
+        row_values = {field: value for field, value in zip(fields, values) if field}
+        row_values["path"] = str(row_values["path"])
+        rows[row_values["path"]] = QuotaRow(*(row_values.get(field) for field in QuotaRow.FIELDS))
+    return rows
+
+
+def get_crossed_thresholds(name, previous_percent, percent, thresholds):
+    changes = list()
+    previous_percent = previous_percent or 0
+    percent = percent or 0
+    for threshold in thresholds:
+        if previous_percent < threshold <= percent:
+            changes.append(f"{name} reached {threshold:g}%")
+        elif percent < threshold <= previous_percent:
+            changes.append(f"{name} dropped below {threshold:g}%")
+    return changes
+
+
+class QuotaDeltaCollector:
+    def __init__(self, previous_rows, min_bytes_change, min_files_change, thresholds):
+        self.previous_rows = previous_rows
+        self.min_bytes_change = min_bytes_change
+        self.min_files_change = min_files_change
+        self.thresholds = sorted(thresholds)
+        self.row_count = 0
+        self.delta_rows = list()
+
+    def get_changes(self, previous, row):
+        if previous is None:
+            return ["new"]
+        if row.bytes_used is None or previous.bytes_used is None:
+            # A directory that wasn't scanned (this time or the last) has nothing to compare
+            return []
+        changes = list()
+        if previous.bytes_quota != row.bytes_quota or previous.files_quota != row.files_quota:
+            changes.append("quota changed")
+        changes.extend(get_crossed_thresholds("bytes", previous.bytes_percent, row.bytes_percent, self.thresholds))
+        changes.extend(get_crossed_thresholds("files", previous.files_percent, row.files_percent, self.thresholds))
+        if not changes and (
+            abs(row.bytes_used - previous.bytes_used) > self.min_bytes_change
+            or abs(row.files_used - previous.files_used) > self.min_files_change
+        ):
+            changes.append("usage changed")
+        return changes
+
+    def get_delta_row(self, changes, previous, row):
+        # Usage changes are signed text, so the email doesn't treat decreases as undefined values
+        bytes_change = files_change = None
+        if not previous is None and not row is None:
+            bytes_change = f"{row.bytes_used - previous.bytes_used:+.2f}"
+            files_change = f"{row.files_used - previous.files_used:+d}"
+        current = row or previous
+        return (
+            current.path,
+            ", ".join(changes),
+            None if row is None else row.bytes_used,
+            bytes_change,
+            None if row is None else row.bytes_percent,
+            None if row is None else row.files_used,
+            files_change,
+            None if row is None else row.files_percent,
+        )
+
+    def collect(self, rows):
+        for row in rows:
+            previous = self.previous_rows.pop(row.path, None)
+            changes = self.get_changes(previous, row)
+            if changes:
+                self.delta_rows.append(self.get_delta_row(changes, previous, row))
+            self.row_count += 1
+            yield row
+
+    def get_delta_rows(self):
+        # Whatever wasn't matched by a row of this run has disappeared since the previous one
+        removed_rows = [self.get_delta_row(["removed"], previous, None) for previous in self.previous_rows.values()]
+        return self.delta_rows + removed_rows
@@ -0,0 +1,98 @@
+import os
+import datetime
+import numpy as np
+
+#
+# Columnar history of the quota report rows, one compressed .npz file per cluster per day:
+#
+#     <history_dir>/<cluster>/<YYYY-MM-DD>.npz
+#
+# Each file holds parallel arrays of the paths and their usages and quotas on that day (quotas are NaN where there
+# is no quota). Projections only ever load the days inside their window, so the cost of an analysis doesn't grow
+# with the amount of history kept.
+#
+
+HISTORY_COLUMNS = ("bytes_quota", "bytes_used", "files_quota", "files_used")
+
+
+def to_float_array(values):
+    return np.array([np.nan if value is None else float(value) for value in values], dtype=np.float64)
+
+
+def get_history_filename(history_dir, cluster, date):
+    return os.path.join(history_dir, cluster, f"{date}.npz")
+
+
+def append_history(history_dir, cluster, date, rows):
+    # Directories that weren't scanned and have no last known values have no usage to record
+    rows = [row for row in rows if not row.bytes_used is None]
+    # A path can be listed twice (directly and under its parent), keep the first occurrence only
+    paths = np.array([row.path for row in rows], dtype=str)
+    paths, first_index = np.unique(paths, return_index=True)
+    columns = {key: to_float_array(getattr(row, key) for row in rows)[first_index] for key in HISTORY_COLUMNS}
+
+    filename = get_history_filename(history_dir, cluster, date)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    # Write through a temporary file so that a failed run never leaves a truncated day behind
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "wb") as f:
+        np.savez_compressed(f, paths=paths, **columns)
+    os.replace(tmp_filename, filename)
+
+
+def project_days_to_full(history_dir, cluster, date, rows, window_days):
+    paths = np.array([row.path for row in rows], dtype=str)
+    sorted_paths, row_index = np.unique(paths, return_inverse=True)
+    path_count = len(sorted_paths)
+
+    # Running sums for a least squares fit of usage against time for every path at once
+    fit_sums = {key: np.zeros((5, path_count)) for key in ("bytes_used", "files_used")}
+    for days_ago in range(window_days + 1):
+        day = date - datetime.timedelta(days=days_ago)
+        filename = get_history_filename(history_dir, cluster, day)
+        if not os.path.exists(filename):
+            continue
+        with np.load(filename) as history:
+            day_paths = history["paths"]
+            if not len(day_paths) or not path_count:
+                continue
+            # Match the paths recorded that day against the paths in this report
+            index = np.searchsorted(sorted_paths, day_paths).clip(max=path_count - 1)
+            found = sorted_paths[index] == day_paths
+            index = index[found]
+            t = float(-days_ago)
+            for key, sums in fit_sums.items():
+                y = history[key][found]
+                sums[0, index] += 1
+                sums[1, index] += t
+                sums[2, index] += t * t
+                sums[3, index] += y
+                sums[4, index] += t * y
+
+    projections = dict()
+    for key, sums in fit_sums.items():
+        n, sum_t, sum_tt, sum_y, sum_ty = sums
+        denominator = n * sum_tt - sum_t * sum_t
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = np.where((n >= 2) & (denominator > 0), (n * sum_ty - sum_t * sum_y) / denominator, np.nan)
+
+            prefix = key.split("_")[0]
+            quota = to_float_array(getattr(row, f"{prefix}_quota") for row in rows)
+            used = to_float_array(getattr(row, key) for row in rows)
+            row_slope = slope[row_index]
+            days_to_full = np.where(row_slope > 0, (quota - used) / row_slope, np.nan)
+            # Directories already at or over their quota are full now
+            days_to_full = np.where(used >= quota, 0.0, days_to_full)
+        projections[key] = days_to_full
+
+    return projections["bytes_used"], projections["files_used"]
+
+
+def add_projections(history_dir, cluster, rows, window_days):
+    # Record today's rows first so they are the last point of each fit
+    today = datetime.date.today()
+    append_history(history_dir, cluster, today, rows)
+    bytes_days, files_days = project_days_to_full(history_dir, cluster, today, rows, window_days)
+    for row, bytes_days_to_full, files_days_to_full in zip(rows, bytes_days, files_days):
+        row.bytes_days_to_full = None if np.isnan(bytes_days_to_full) else round(float(bytes_days_to_full), 1)
+        row.files_days_to_full = None if np.isnan(files_days_to_full) else round(float(files_days_to_full), 1)
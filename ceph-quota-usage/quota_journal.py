@@ -0,0 +1,60 @@
+import os
+import json
+import threading
+
+#
+# Append-only journal of the report rows a scan has finished, so an interrupted run can be resumed.
+# Each line is the JSON of [path, row], where row is None for a directory without a report entry.
+# Several processes (one per mount or shard) can append to the same journal, every flush is a
+# single write to a file opened for appending.
+#
+
+
+class QuotaScanJournal:
+    # How many rows are buffered before they're written out, at most this many are scanned again after a crash
+    FLUSH_ROWS = 1000
+
+    def __init__(self, filename, resume=False):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.pending_lines = list()
+        # A run that isn't resuming still journals its rows, it just doesn't reuse any
+        self.journaled_rows = dict()
+        if resume and os.path.exists(filename):
+            with open(filename) as f:
+                for line in f:
+                    try:
+                        path, row = json.loads(line)
+                    except ValueError:
+                        # The last line of a run that was killed mid-write
+                        continue
+                    self.journaled_rows[path] = row
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def get(self, path):
+        # Returns (True, row) if the path was journaled, where row may be None for a directory
+        # that didn't have a report entry, otherwise (False, None)
+        if path not in self.journaled_rows:
+            return False, None
+        return True, self.journaled_rows[path]
+
+    def put(self, path, row):
+        line = json.dumps([path, row]) + "\n"
+        with self.lock:
+            self.pending_lines.append(line)
+            if len(self.pending_lines) < self.FLUSH_ROWS:
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending_lines, self.pending_lines = self.pending_lines, list()
+            if pending_lines and not self.fd is None:
+                os.write(self.fd, "".join(pending_lines).encode())
+                os.fsync(self.fd)
+
+    def close(self):
+        if not self.fd is None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
@@ -0,0 +1,89 @@
+import operator
+
+
+class QuotaRow:
+    # The quota (and percent used) fields of a directory that doesn't have that quota
+    NO_QUOTA = None
+    # Report column titles, in report order, of each field a row can be written with
+    COLUMNS = {
+        "path": "Path",
+        "bytes_quota": "Byte Quota (Gibibytes)",
+        "bytes_used": "Byte Usage (Gibibytes)",
+        "bytes_percent": "Percent Bytes Used (%)",
+        "files_quota": "File Count Quota",
+        "files_used": "File Count Usage",
+        "files_percent": "Percent File Count Used (%)",
+        "last_modified_date": "Last Modified",
+        "backing_pool": "Backing Pool",
+        "bytes_days_to_full": "Days Until Byte Quota Is Full",
+        "files_days_to_full": "Days Until File Count Quota Is Full",
+        "scan_status": "Scan Status",
+    }
+    # The fields read from CephFS, which every report has
+    FIELDS = tuple(COLUMNS)[:9]
+    # Fields that can hold NO_QUOTA (or no projection)
+    OPTIONAL_FIELDS = (
+        "bytes_quota",
+        "bytes_percent",
+        "files_quota",
+        "files_percent",
+        "bytes_days_to_full",
+        "files_days_to_full",
+    )
+    # Scan statuses of a row whose values are the last known ones, rather than read on this run
+    TIMED_OUT = "timed out"
+    UNSCANNED = "unscanned"
+    __slots__ = tuple(COLUMNS)
+
+    def __init__(
+        self,
+        path,
+        bytes_quota,
+        bytes_used,
+        bytes_percent,
+        files_quota,
+        files_used,
+        files_percent,
+        last_modified_date,
+        backing_pool,
+        bytes_days_to_full=None,
+        files_days_to_full=None,
+        scan_status=None,
+    ):
+        self.path = path
+        self.bytes_quota = bytes_quota
+        self.bytes_used = bytes_used
+        self.bytes_percent = bytes_percent
+        self.files_quota = files_quota
+        self.files_used = files_used
+        self.files_percent = files_percent
+        self.last_modified_date = last_modified_date
+        self.backing_pool = backing_pool
+        self.bytes_days_to_full = bytes_days_to_full
+        self.files_days_to_full = files_days_to_full
+        self.scan_status = scan_status
+
+    def __repr__(self):
+        return f"QuotaRow({', '.join(repr(getattr(self, field)) for field in self.__slots__)})"
+
+    @classmethod
+    def unread(cls, path, scan_status):
+        # The row of a directory that wasn't read on this run and doesn't have last known values either
+        return cls(path, *([None] * (len(cls.FIELDS) - 1)), scan_status=scan_status)
+
+    def to_tuple(self, fields=FIELDS):
+        return tuple(getattr(self, field) for field in fields)
+
+    def has_quota(self):
+        return self.bytes_quota is not self.NO_QUOTA or self.files_quota is not self.NO_QUOTA
+
+    @classmethod
+    def header(cls, fields=FIELDS):
+        return tuple(cls.COLUMNS[field] for field in fields)
+
+    @classmethod
+    def sort_key(cls, field):
+        if field == "path":
+            return operator.attrgetter(field)
+        # Directories without a quota (or without any values, see unread) sort below every directory with one
+        return lambda row: (getattr(row, field) is not None, getattr(row, field) or 0)
@@ -0,0 +1,86 @@
+import os
+import json
+import sqlite3
+import threading
+
+#
+# Persistent per-directory snapshot of the last run's report rows, keyed on ceph.dir.rctime.
+# ceph.dir.rctime is the most recent ctime of anything underneath a directory (including a change
+# to the directory's own quota), so a directory whose rctime has not moved has the same row as last time.
+#
+
+
+class QuotaSnapshot:
+    # How many rows are buffered before they're written to the snapshot file
+    FLUSH_ROWS = 1000
+
+    def __init__(self, filename, cluster, full=False):
+        self.cluster = cluster
+        self.lock = threading.Lock()
+        self.pending_rows = list()
+        self.connection = sqlite3.connect(filename, timeout=300, check_same_thread=False)
+        with self.connection:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS quota_rows ("
+                "cluster TEXT NOT NULL, path TEXT NOT NULL, rctime TEXT NOT NULL, row TEXT, "
+                "PRIMARY KEY (cluster, path))"
+            )
+        # A full run still records every row it reads, it just doesn't reuse any (other than the
+        # last known rows of directories that couldn't be read)
+        self.full = full
+        self.previous_rows = dict()
+        self.subdir_paths = None
+        cursor = self.connection.execute("SELECT path, rctime, row FROM quota_rows WHERE cluster = ?", (cluster,))
+        for path, rctime, row in cursor:
+            self.previous_rows[path] = (rctime, row)
+
+    def get(self, path, rctime):
+        # Returns (True, row) if the path is unchanged since the snapshot, where row may be None for
+        # a directory that didn't have a report entry, otherwise (False, None)
+        previous = self.previous_rows.get(path)
+        if self.full or previous is None or previous[0] != rctime:
+            return False, None
+        return True, (json.loads(previous[1]) if previous[1] is not None else None)
+
+    def get_last(self, path):
+        # The last known row of the path, for a directory that couldn't be read on this run. Returns
+        # (True, row) if the path is in the snapshot, where row may be None for a directory that
+        # didn't have a report entry, otherwise (False, None)
+        previous = self.previous_rows.get(path)
+        if previous is None:
+            return False, None
+        return True, (json.loads(previous[1]) if previous[1] is not None else None)
+
+    def get_last_subdirs(self, path):
+        # The paths of the directories directly under path in the snapshot, for a directory that
+        # couldn't be listed on this run
+        with self.lock:
+            if self.subdir_paths is None:
+                self.subdir_paths = dict()
+                for subdir_path in self.previous_rows:
+                    self.subdir_paths.setdefault(os.path.dirname(subdir_path), list()).append(subdir_path)
+        return self.subdir_paths.get(path, [])
+
+    def put(self, path, rctime, row):
+        row = json.dumps(row) if row is not None else None
+        with self.lock:
+            self.pending_rows.append((self.cluster, path, rctime, row))
+            # A long running process can reuse the row on its next pass too
+            self.previous_rows[path] = (rctime, row)
+            if len(self.pending_rows) < self.FLUSH_ROWS:
+                return
+        self.flush()
+
+    def flush(self):
+        # The connection is shared by the scan's threads, so only one of them writes at a time
+        with self.lock:
+            pending_rows, self.pending_rows = self.pending_rows, list()
+            if pending_rows:
+                with self.connection:
+                    self.connection.executemany("INSERT OR REPLACE INTO quota_rows VALUES (?, ?, ?, ?)", pending_rows)
+
+    def close(self):
+        if not self.connection is None:
+            self.flush()
+            self.connection.close()
+            self.connection = None
@@ -0,0 +1,153 @@
+import csv
+import json
+import datetime
+
+#
+# Writers for the report files. Every report is written as CSV (which the email attaches), and can
+# also be written as JSON Lines, Parquet or Arrow IPC files with the same rows. In those, values that
+# are "-" in the CSV (e.g. no quota) are null, and the quota report's columns have fixed types.
+#
+
+# Arrow type names of the quota report's fields, the types of other tables' fields are inferred
+FIELD_TYPES = {
+    "path": "string",
+    "bytes_quota": "float64",
+    "bytes_used": "float64",
+    "bytes_percent": "float64",
+    "files_quota": "int64",
+    "files_used": "int64",
+    "files_percent": "float64",
+    "last_modified_date": "date32",
+    "backing_pool": "string",
+    "bytes_days_to_full": "float64",
+    "files_days_to_full": "float64",
+    "scan_status": "string",
+}
+
+
+class ReportWriter:
+    extension = None
+
+    def __init__(self, filename, header, fields):
+        self.filename = filename
+        self.header = header
+        self.fields = fields
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, values):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class CSVReportWriter(ReportWriter):
+    extension = "csv"
+
+    def __init__(self, filename, header, fields):
+        super().__init__(filename, header, fields)
+        self.file = open(filename, "w", newline="")
+        self.writer = csv.writer(self.file, delimiter=",", quotechar="|", quoting=csv.QUOTE_MINIMAL)
+        self.writer.writerow(header)
+
+    def write(self, values):
+        self.writer.writerow(["-" if value is None else value for value in values])
+
+    def close(self):
+        self.file.close()
+
+
+class JSONLinesReportWriter(ReportWriter):
+    extension = "jsonl"
+
+    def __init__(self, filename, header, fields):
+        super().__init__(filename, header, fields)
+        self.file = open(filename, "w")
+
+    def write(self, values):
+        self.file.write(json.dumps(dict(zip(self.fields, values))))
+        self.file.write("\n")
+
+    def close(self):
+        self.file.close()
+
+
+class ArrowReportWriter(ReportWriter):
+    # Writes the rows to an Arrow IPC file a record batch at a time
+    extension = "arrow"
+    batch_size = 65536
+
+    def __init__(self, filename, header, fields):
+        super().__init__(filename, header, fields)
+        # pyarrow is only needed when writing Arrow or Parquet files
+        import pyarrow
+
+        self.pa = pyarrow
+        self.rows = list()
+        self.schema = None
+        self.writer = None
+
+    def write(self, values):
+        self.rows.append(values)
+        if len(self.rows) >= self.batch_size:
+            self.write_batch()
+
+    def get_type(self, i):
+        if not self.schema is None:
+            return self.schema.field(i).type
+        type_name = FIELD_TYPES.get(self.fields[i])
+        return getattr(self.pa, type_name)() if type_name else None
+
+    def get_array(self, i, column):
+        arrow_type = self.get_type(i)
+        if arrow_type == self.pa.date32():
+            parse_date = lambda value: datetime.datetime.strptime(value, "%Y-%m-%d").date()
+            column = [None if value is None else parse_date(value) for value in column]
+        if arrow_type is None and not column:
+            arrow_type = self.pa.null()
+        return self.pa.array(column, type=arrow_type)
+
+    def write_batch(self):
+        columns = list(zip(*self.rows)) if self.rows else [()] * len(self.fields)
+        arrays = [self.get_array(i, list(column)) for i, column in enumerate(columns)]
+        batch = self.pa.RecordBatch.from_arrays(arrays, names=list(self.fields))
+        if self.writer is None:
+            # Fields whose type isn't fixed take the type of their values in the first batch
+            self.schema = batch.schema
+            self.writer = self.open_writer()
+        self.write_record_batch(batch)
+        self.rows = list()
+
+    def open_writer(self):
+        return self.pa.ipc.new_file(self.filename, self.schema)
+
+    def write_record_batch(self, batch):
+        self.writer.write_batch(batch)
+
+    def close(self):
+        if self.rows or self.writer is None:
+            self.write_batch()
+        self.writer.close()
+
+
+class ParquetReportWriter(ArrowReportWriter):
+    extension = "parquet"
+
+    def open_writer(self):
+        import pyarrow.parquet
+
+        return pyarrow.parquet.ParquetWriter(self.filename, self.schema)
+
+    def write_record_batch(self, batch):
+        self.writer.write_table(self.pa.Table.from_batches([batch]))
+
+
+# The formats that reports can be written in besides CSV
+EXPORT_WRITERS = {
+    writer.extension: writer for writer in (JSONLinesReportWriter, ParquetReportWriter, ArrowReportWriter)
+}
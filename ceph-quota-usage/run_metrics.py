@@ -0,0 +1,124 @@
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+#
+# Timing and counters for one report run. Phase times are wall times, with the time of any phase
+# nested in another (on the same thread) only counted towards the inner one. The times of phases
+# that run at the same time on different threads add up.
+#
+
+# Upper bounds (in seconds) of the latency histogram buckets, the last bucket holds everything slower
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class RunMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.reset()
+
+    def reset(self):
+        self.start_time = time.time()
+        self.phases = dict()
+        self.latencies = dict()
+        self.counters = dict()
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        outer_nested_seconds = getattr(self.local, "nested_seconds", 0)
+        self.local.nested_seconds = 0
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.add_phase(name, elapsed - self.local.nested_seconds)
+            self.local.nested_seconds = outer_nested_seconds + elapsed
+
+    def timed_iter(self, name, iterable):
+        # Counts the time spent producing each item of iterable (e.g. scanning a directory) towards
+        # the phase name, and the time spent consuming it towards the enclosing phase
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def get_histogram(self, name):
+        histogram = self.latencies.get(name)
+        if histogram is None:
+            histogram = self.latencies[name] = {"count": 0, "sum": 0, "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        return histogram
+
+    def observe_latency(self, name, seconds):
+        with self.lock:
+            histogram = self.get_histogram(name)
+            histogram["count"] += 1
+            histogram["sum"] += seconds
+            histogram["buckets"][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def merge(self, summary):
+        # Adds the summary of a run in another process (from to_dict) into this run's metrics
+        for name, seconds in summary["phases"].items():
+            self.add_phase(name, seconds)
+        for name, n in summary["counters"].items():
+            self.count(name, n)
+        with self.lock:
+            for name, other in summary["latencies"].items():
+                histogram = self.get_histogram(name)
+                histogram["count"] += other["count"]
+                histogram["sum"] += other["sum_seconds"]
+                for i, n in enumerate(other["buckets"].values()):
+                    histogram["buckets"][i] += n
+
+    def to_dict(self):
+        bucket_names = [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]
+        with self.lock:
+            return {
+                "start_time": self.start_time,
+                "wall_seconds": time.time() - self.start_time,
+                "phases": dict(self.phases),
+                "counters": dict(self.counters),
+                # Each bucket counts the calls that took at most its bound and longer than the bound before it
+                "latencies": {
+                    name: {
+                        "count": histogram["count"],
+                        "sum_seconds": histogram["sum"],
+                        "buckets": dict(zip(bucket_names, histogram["buckets"])),
+                    }
+                    for name, histogram in self.latencies.items()
+                },
+            }
+
+    def write(self, filename):
+        with open(filename, "w") as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+    def get_summary_lines(self):
+        # A short human readable version of the metrics, for the report email
+        summary = self.to_dict()
+        counters = ", ".join(f"{name.replace('_', ' ')}: {n}" for name, n in sorted(summary["counters"].items()))
+        phases = ", ".join(f"{name.replace('_', ' ')} {seconds:.2f}s" for name, seconds in summary["phases"].items())
+        lines = [f"Report run took {summary['wall_seconds']:.2f}s ({phases}).", f"Directories {counters}."]
+        for name, histogram in sorted(summary["latencies"].items()):
+            if histogram["count"]:
+                mean_ms = histogram["sum_seconds"] / histogram["count"] * 1000
+                lines.append(f"{name}: {histogram['count']} calls, {mean_ms:.2f}ms on average.")
+        return lines
+
+
+metrics = RunMetrics()
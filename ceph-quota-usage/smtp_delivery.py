@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import shutil
+import smtplib
+
+#
+# Delivery of report emails over one reused SMTP connection, with retries of transient failures and an
+# on-disk queue of the messages that still couldn't be delivered, which is flushed on the next run.
+#
+# Messages are handed over as files of the already flattened message (with CRLF line endings), and
+# are streamed from those files to the server.
+#
+
+
+def is_transient_error(e):
+    # 4xx replies are temporary failures by definition, anything that broke the connection is worth a retry
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return all(400 <= code < 500 for code, response in e.recipients.values())
+    if isinstance(e, smtplib.SMTPResponseException):
+        return 400 <= e.smtp_code < 500
+    if isinstance(e, smtplib.SMTPServerDisconnected):
+        return True
+    # Every SMTPException is an OSError, but the others (e.g. a missing extension) would only fail again
+    if isinstance(e, smtplib.SMTPException):
+        return False
+    return isinstance(e, OSError)
+
+
+def send_message_file(smtp, sender, receivers, message_file, chunk_size=65536):
+    # Like SMTP.sendmail, but the message is read from a file as it is sent rather than held in memory.
+    # If the server supports PIPELINING, the envelope commands are sent without waiting for each reply.
+    smtp.ehlo_or_helo_if_needed()
+    commands = [("mail", f"FROM:{smtplib.quoteaddr(sender)}")]
+    commands.extend(("rcpt", f"TO:{smtplib.quoteaddr(receiver)}") for receiver in receivers)
+    commands.append(("data", ""))
+    if smtp.has_extn("pipelining"):
+        for command in commands:
+            smtp.putcmd(*command)
+        replies = [smtp.getreply() for command in commands]
+    else:
+        replies = list()
+        for command in commands:
+            smtp.putcmd(*command)
+            replies.append(smtp.getreply())
+            if command[0] == "mail" and replies[-1][0] != 250:
+                break
+
+    code, response = replies[0]
+    if code != 250:
+        if len(replies) == len(commands) and replies[-1][0] == 354:
+            # The server accepted DATA anyway, so end the empty message before resetting
+            smtp.send(b".\r\n")
+            smtp.getreply()
+        smtp.rset()
+        raise smtplib.SMTPSenderRefused(code, response, sender)
+    refused = dict()
+    for receiver, (code, response) in zip(receivers, replies[1:-1]):
+        if code not in (250, 251):
+            refused[receiver] = (code, response)
+    code, response = replies[-1]
+    if code != 354:
+        smtp.rset()
+        if len(refused) == len(receivers):
+            raise smtplib.SMTPRecipientsRefused(refused)
+        raise smtplib.SMTPDataError(code, response)
+
+    message_file.seek(0)
+    line = b"\r\n"
+    chunk = list()
+    chunk_length = 0
+    for line in message_file:
+        # Escape leading periods, as SMTP.data does
+        if line.startswith(b"."):
+            line = b"." + line
+        chunk.append(line)
+        chunk_length += len(line)
+        if chunk_length >= chunk_size:
+            smtp.send(b"".join(chunk))
+            chunk = list()
+            chunk_length = 0
+    if not line.endswith(b"\r\n"):
+        chunk.append(b"\r\n")
+    chunk.append(b".\r\n")
+    smtp.send(b"".join(chunk))
+    code, response = smtp.getreply()
+    if code != 250:
+        raise smtplib.SMTPDataError(code, response)
+    return refused
+
+
+class MailDelivery:
+    RETRY_DELAY = 5
+    smtp = None
+    queued_count = 0
+
+    def __init__(self, host, port, queue_dir=None, retries=3, retry_delay=RETRY_DELAY):
+        self.host = host
+        self.port = port
+        self.queue_dir = queue_dir
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def get_connection(self):
+        if self.smtp is None:
+            self.smtp = smtplib.SMTP(self.host, self.port)
+        return self.smtp
+
+    def close(self):
+        if not self.smtp is None:
+            try:
+                self.smtp.quit()
+            except (smtplib.SMTPException, OSError):
+                self.smtp.close()
+            self.smtp = None
+
+    def try_send(self, sender, receivers, message_file):
+        # Returns None if the message was sent, otherwise the error it finally failed with
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.retry_delay * 2 ** (attempt - 1))
+            try:
+                refused = send_message_file(self.get_connection(), sender, receivers, message_file)
+                for receiver, (code, response) in refused.items():
+                    print(f"Error sending email to {receiver}\n\tError : {code} {response}\n")
+                return None
+            except (smtplib.SMTPException, OSError) as e:
+                error = e
+                if not is_transient_error(e):
+                    break
+                # Start over on a fresh connection
+                self.close()
+        return error
+
+    def send(self, sender, receivers, message_file):
+        # Returns whether the message was sent, queuing it to be sent on a later run if it failed with
+        # a transient error. A message the server refused outright would only be refused again.
+        error = self.try_send(sender, receivers, message_file)
+        if error is None:
+            return True
+        print(f"Error sending email to {', '.join(receivers)}\n\tError : {error}\n")
+        if self.queue_dir and is_transient_error(error):
+            self.queue(sender, receivers, message_file)
+        return False
+
+    def send_batch(self, messages):
+        # Sends (sender, receivers, message_file) messages one after another over the same connection,
+        # returning how many were sent. Once a message can't be sent even after its retries, the server
+        # is taken to be down and the rest are queued straight away rather than each being retried.
+        sent_count = 0
+        server_down = False
+        for sender, receivers, message_file in messages:
+            if not server_down:
+                error = self.try_send(sender, receivers, message_file)
+                if error is None:
+                    sent_count += 1
+                    continue
+                print(f"Error sending email to {', '.join(receivers)}\n\tError : {error}\n")
+                server_down = is_transient_error(error)
+                if not server_down:
+                    continue
+            if self.queue_dir:
+                self.queue(sender, receivers, message_file)
+        return sent_count
+
+    def queue(self, sender, receivers, message_file):
+        os.makedirs(self.queue_dir, exist_ok=True)
+        # A batch's message files can be reused (and have the same id) within the same second
+        self.queued_count += 1
+        name = f"{time.strftime('%Y%m%d%H%M%S')}-{os.getpid()}-{id(message_file)}-{self.queued_count}"
+        message_file.seek(0)
+        with open(os.path.join(self.queue_dir, f"{name}.eml"), "wb") as f:
+            shutil.copyfileobj(message_file, f)
+        # The envelope is written last (and moved into place whole), so a message is only ever flushed
+        # once it is complete
+        envelope_path = os.path.join(self.queue_dir, f"{name}.json")
+        with open(f"{envelope_path}.tmp", "w") as f:
+            json.dump({"sender": sender, "receivers": list(receivers)}, f)
+        os.replace(f"{envelope_path}.tmp", envelope_path)
+        print(f"Queued email to {', '.join(receivers)} in {self.queue_dir}")
+
+    def flush_queue(self):
+        # Sends the queued messages, oldest first. Like in send_batch, once one fails with a transient
+        # error the server is taken to be down, and the rest are left queued for the next run.
+        if not self.queue_dir or not os.path.isdir(self.queue_dir):
+            return
+        for envelope_filename in sorted(os.listdir(self.queue_dir)):
+            if not envelope_filename.endswith(".json"):
+                continue
+            envelope_path = os.path.join(self.queue_dir, envelope_filename)
+            message_path = f"{envelope_path[:-len('.json')]}.eml"
+            try:
+                with open(envelope_path) as f:
+                    envelope = json.load(f)
+                sender, receivers = envelope["sender"], envelope["receivers"]
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                # Left in the queue directory to be looked at, rather than failing every run
+                print(f"Error reading queued email {envelope_path}\n\tError : {e}\n")
+                continue
+            with open(message_path, "rb") as message_file:
+                error = self.try_send(sender, receivers, message_file)
+            if error is None or not is_transient_error(error):
+                # A message the server refused outright is dropped rather than tried again on every run
+                os.remove(envelope_path)
+                os.remove(message_path)
+            if not error is None:
+                print(f"Error sending queued email {message_path}\n\tError : {error}\n")
+                if is_transient_error(error):
+                    return